@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times mdsite's helpers and routes against a synthetic site.
+
+    python -m benchmarks.run --pages 10000 --output after.json \\
+        --compare before.json
+"""
+import os
+import sys
+import json
+import random
+import resource
+import shutil
+import tempfile
+import traceback
+from argparse import ArgumentParser
+from timeit import default_timer
+from mdsite import app, helpers as h
+from mdsite.siteindex import SiteIndex
+from .sitegen import generate
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "templates")
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench(name, func, items, repeat, setup=None):
+    """Calls func on every item, repeat times, in a forked child process,
+    and returns the seconds per call along with how far the child's peak
+    memory grew. The child starts with a fresh peak, so that is the memory
+    this benchmark alone touched; it also leaves no caches behind."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            os.write(w, json.dumps(_bench(func, items, repeat, setup)))
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(w)
+    chunks = []
+    for chunk in iter(lambda: os.read(r, 65536), b""):
+        chunks.append(chunk)
+    os.close(r)
+    if os.waitpid(pid, 0)[1] != 0:
+        raise RuntimeError("Benchmark %s failed." % name)
+    result = json.loads(b"".join(chunks))
+    sys.stdout.write("%-24s %12.1f us/call %10d KB\n" % \
+        (name, result["median"] * 1e6, result["maxrss_kb"]))
+    return result
+
+def _bench(func, items, repeat, setup):
+    times = []
+    rss = _maxrss()
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        for x in items:
+            func(x)
+        times.append((default_timer() - start) / max(len(items), 1))
+    times.sort()
+    return {"calls": len(items), "repeat": repeat, "min": times[0],
+        "median": times[len(times) // 2], "maxrss_kb": _maxrss() - rss}
+
+def run(markdowns, dirs, args):
+    rng = random.Random(args.seed)
+    pages = [os.path.join(d, x) for d in dirs for x in os.listdir(d) \
+        if x.endswith(".md")]
+    sample = rng.sample(pages, min(args.sample, len(pages)))
+    sample_dirs = rng.sample(dirs, min(args.sample, len(dirs)))
+    cache_size = h.page_cache.maxsize
+    cold = lambda: h.page_cache.resize(0)
+    warm = lambda: h.page_cache.resize(max(cache_size, len(pages)))
+    results = dict()
+    results["make_nav_cache"] = bench("make_nav_cache", h.make_nav_cache,
+        sample_dirs, args.repeat, cold)
+    for d in dirs:  # Every directory needs a nav cache from here on.
+        h.make_nav_cache(d)
+    if args.site_index:
+        SiteIndex(markdowns).build()
+    results["get_page_cold"] = bench("get_page (cold)", h.get_page, sample,
+        args.repeat, cold)
+    results["get_page_body_cold"] = bench("get_page + body (cold)",
+        lambda x: h.get_page(x)["body"], sample, args.repeat, cold)
+    warm()
+    for x in sample:
+        h.get_page(x)
+    results["get_page_warm"] = bench("get_page (warm)", h.get_page, sample,
+        args.repeat)
+    results["load_nav"] = bench("load_nav", h.load_nav, sample_dirs,
+        args.repeat)
+    results["make_context"] = bench("make_context",
+        lambda x: h.make_context(h.get_page(x)), sample, args.repeat)
+    results["make_feed"] = bench("make_feed",
+        lambda x: h.make_feed(x, None, 20), [markdowns], args.repeat)
+    app.config.update(MD_FILES=markdowns)
+    app.template_folder = TEMPLATES
+    client = app.test_client()
+    urls = ["/%s" % h.get_page(x)["path"] for x in sample]
+    client.get(urls[0])  # Configures the app before the children fork.
+    results["http_page"] = bench("GET page", client.get, urls, args.repeat)
+    results["http_page_gzip"] = bench("GET page (gzip)",
+        lambda x: client.get(x, headers={"Accept-Encoding": "gzip"}), urls,
+        args.repeat)
+    results["http_atom"] = bench("GET /atom", client.get, ["/atom"],
+        args.repeat)
+    h.page_cache.resize(cache_size)
+    return results
+
+def compare(results, previous, threshold):
+    """Prints how each benchmark moved and returns the names of those that
+    got slower than threshold times their previous median."""
+    slower = []
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        ratio = results[name]["median"] / max(previous[name]["median"], 1e-12)
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- slower"
+            slower.append(name)
+        sys.stdout.write("%-24s %8.2fx%s\n" % (name, ratio, flag))
+    return slower
+
+def main():
+    ap = ArgumentParser(description="Benchmarks mdsite on a synthetic site.")
+    ap.add_argument("--pages", type=int, default=1000)
+    ap.add_argument("--fanout", type=int, default=10,
+        help="subdirectories per directory")
+    ap.add_argument("--depth", type=int, default=2,
+        help="levels of subdirectories")
+    ap.add_argument("--body", type=int, default=2000,
+        help="approximate body size in characters")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--sample", type=int, default=100,
+        help="pages and directories timed per benchmark")
+    ap.add_argument("--site-index", action="store_true",
+        help="build a _site_index before the read benchmarks")
+    ap.add_argument("--keep", help="generate the site here and keep it")
+    ap.add_argument("--output", help="write results to this JSON file")
+    ap.add_argument("--compare", help="JSON file of an earlier run")
+    ap.add_argument("--threshold", type=float, default=1.2,
+        help="slowdown ratio reported as a regression")
+    args = ap.parse_args()
+    root = args.keep or tempfile.mkdtemp(prefix="mdsite-bench-")
+    markdowns = os.path.join(root, "markdown")
+    try:
+        sys.stdout.write("Generating %d pages in %s\n" % \
+            (args.pages, markdowns))
+        dirs = generate(markdowns, args.pages, args.fanout, args.depth,
+            args.body, args.seed)
+        results = run(os.path.realpath(markdowns),
+            [os.path.realpath(d) for d in dirs], args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+    params = dict((k, getattr(args, k)) for k in ("pages", "fanout", "depth",
+        "body", "seed", "repeat", "sample", "site_index"))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps({"params": params, "python": sys.version,
+                "results": results}, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.loads(f.read())
+        if previous.get("params") != params:
+            sys.stdout.write("Warning: the runs used different parameters.\n")
+        if compare(results, previous["results"], args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+from datetime import datetime, timedelta
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+    "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+def _directories(root, fanout, depth):
+    dirs = [root]
+    level = [root]
+    for i in range(depth):
+        level = [os.path.join(d, "dir%d" % n) for d in level \
+            for n in range(fanout)]
+        dirs += level
+    return dirs
+
+def _text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        w = rng.choice(WORDS)
+        words.append(w)
+        length += len(w) + 1
+    return " ".join(words)
+
+def _write_page(filename, rng, title, stamp, weight, body_size):
+    # Roughly a heading, a few paragraphs and a list per page.
+    paragraphs = ["## %s" % title.capitalize()]
+    while sum(len(x) for x in paragraphs) < body_size:
+        paragraphs.append(_text(rng, 400))
+        paragraphs.append("\n".join("* %s" % _text(rng, 30) for i in range(3)))
+    lines = [
+        u"Title: %s" % title.capitalize(),
+        u"Description: %s" % _text(rng, 80),
+        u"Keywords: %s" % ", ".join(rng.sample(WORDS, 4)),
+        u"Template: ",
+        u"Image: ",
+        u"Thumbnail: ",
+        u"Timestamp: %s" % stamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        u"Date: %s" % stamp.strftime("%A, %d %B %Y - %H:%M:%S"),
+        u"Weight: %d" % weight,
+        u"Body:",
+        u"\n\n".join(paragraphs),
+    ]
+    with open(filename, "w") as f:
+        f.write(u"\n".join(lines).encode("utf-8"))
+
+def generate(root, pages=1000, fanout=10, depth=2, body_size=2000, seed=0):
+    """Writes a synthetic site to root, which must be a directory named
+    "markdown". Every directory gets an index.md and the pages are spread
+    evenly over all directories. Returns the list of directories."""
+    if os.path.basename(os.path.normpath(root)) != "markdown":
+        raise ValueError("The site root must be a directory named markdown.")
+    rng = random.Random(seed)
+    dirs = _directories(root, fanout, depth)
+    start = datetime(2015, 1, 1)
+    for i, d in enumerate(dirs):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        _write_page(os.path.join(d, "index.md"), rng, "directory %d" % i,
+            start, i, body_size)
+    for n in range(pages):
+        d = dirs[n % len(dirs)]
+        _write_page(os.path.join(d, "page%d.md" % n), rng,
+            " ".join(rng.sample(WORDS, 3)), start + timedelta(minutes=n),
+            rng.randint(0, 100), body_size)
+    return dirs
@@ -1,27 +1,242 @@
 # -*- coding: utf-8 -*-
 import os
-from flask import Flask, redirect, render_template, url_for
-from jinja2 import TemplateNotFound
-from .helpers import get_page, make_context, make_feed, make_404, make_500
+import gc
+import gzip
+import json
+import hashlib
+from datetime import datetime
+from io import BytesIO
+from flask import Flask, Response, jsonify, make_response, redirect, \
+    render_template, request, send_file, url_for
+from jinja2 import FileSystemBytecodeCache, Markup, TemplateNotFound
+from . import helpers
+from .helpers import LRUCache, feed_mtimes, get_mtimes, get_page, \
+    iter_nav, iter_site, make_context, make_feed, make_404, make_500, \
+    nav_mtime, page_cache, render_cache, use_snapshot
+from .search import SearchIndex
+from .sitemap import iter_urlset
+from .snapshot import Snapshot
+from .timing import timings
+from .watcher import Watcher
 
-def respond(context):
+# Rendered ATOM feeds, keyed by ETag.
+feed_cache = LRUCache(4)
+# Gzipped response bodies, keyed by ETag.
+gzip_cache = LRUCache(256)
+# Rendered _nav.html fragments, keyed by directory and listing.
+fragment_cache = LRUCache(256)
+
+def conditional(key, mtimes, render, content_type="text/html; charset=utf-8"):
+    """Answers with 304 if the client's copy is still current, otherwise
+    with the output of render(), gzipped when the client accepts it."""
+    etag = hashlib.sha1(repr((key, mtimes))).hexdigest()
+    last_modified = datetime.utcfromtimestamp(int(max(mtimes) or 0))
+    headers = {"content-type": content_type, "vary": "Accept-Encoding"}
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = request.if_modified_since is not None and \
+            request.if_modified_since >= last_modified
+    gzipped = request.accept_encodings["gzip"] > 0
+    cached = gzip_cache.get(etag) if gzipped and not fresh else None
+    if fresh:
+        response = make_response("", 304, headers)
+    elif cached is not None:
+        response = make_response(cached, 200, headers)
+    else:
+        body = render()
+        if isinstance(body, tuple):  # Errors are not cached.
+            return body
+        if gzipped:
+            buf = BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+                f.write(body.encode("utf-8"))
+            body = buf.getvalue()
+            gzip_cache.put(etag, body)
+        response = make_response(body, 200, headers)
+    if gzipped and not fresh:
+        response.headers["content-encoding"] = "gzip"
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+def public(data, **extra):
+    # The JSON API leaves out server file system paths.
+    data = dict(data, **extra)
+    data.pop("filename", None)
+    data.pop("template", None)
+    return data
+
+def ndjson(pairs):
+    # One JSON object per line, sent as the lines are produced.
+    def lines():
+        for kind, entry in pairs:
+            yield json.dumps(public(entry, kind=kind)) + "\n"
+    return Response(lines(), mimetype="application/x-ndjson")
+
+def render_nav(context):
+    """Returns _nav.html rendered for the context's listing. All pages of a
+    directory share it until the directory's nav data or the template
+    changes."""
     try:
-        t = render_template(context["page"]["template"], **context)
+        template = app.jinja_env.get_template("_nav.html")
     except TemplateNotFound:
-        t = render_template("_failsafe.html", **context)
+        return u""
+    page = context["page"]
+    path = os.path.dirname(page["filename"])
+    key = (path, page["filename"].endswith("index.md"), context["nav_offset"],
+        len(context["files"]), context["nav_page"], context["nav_pages"])
+    validator = (nav_mtime(path), template)
+    nav = fragment_cache.get(key, validator)
+    if nav is None:
+        nav = Markup(template.render(context))
+        fragment_cache.put(key, nav, validator)
+    return nav
+
+def respond(context):
+    try:
+        # Convert the markdown first so that "render" only times Jinja.
+        context["page"]["body"]
+        with timings.phase("render"):
+            context["nav"] = render_nav(context)
+            try:
+                t = render_template(context["page"]["template"], **context)
+            except TemplateNotFound:
+                t = render_template("_failsafe.html", **context)
     except:
         t = make_500()
     return t
 
+def respond_conditionally(page):
+    templates = os.path.join(app.root_path, app.template_folder)
+    nav_page = request.args.get("page", 1, type=int)
+    return conditional((page["filename"], nav_page),
+        get_mtimes(page, templates), lambda: respond(make_context(page,
+            nav_page, app.config.get("MD_NAV_PAGE_SIZE"),
+            app.config.get("MD_NAV_WINDOW"))))
+
 app = Flask("mdsite")
 
+def preload():
+    """Loads the snapshot named by the MD_SNAPSHOT setting: a file written
+    by make-snapshot, or True to build one from MD_FILES. Call this in the
+    master process before workers fork (e.g. in the app module gunicorn
+    loads with --preload) so they share the snapshot copy-on-write."""
+    setting = app.config.get("MD_SNAPSHOT")
+    if not setting or helpers.snapshot is not None:
+        return
+    if setting is True:
+        use_snapshot(Snapshot.build(app.config["MD_FILES"]))
+    else:
+        use_snapshot(Snapshot.load(setting))
+    # Keep the garbage collector from touching, and so copying, its pages.
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+@app.before_first_request
+def configure():
+    preload()
+    page_cache.resize(app.config.get("MD_PAGE_CACHE_SIZE", 256))
+    gzip_cache.resize(app.config.get("MD_GZIP_CACHE_SIZE", 256))
+    fragment_cache.resize(app.config.get("MD_FRAGMENT_CACHE_SIZE", 256))
+    bytecode_cache = app.config.get("MD_BYTECODE_CACHE")
+    if bytecode_cache:
+        if not os.path.isdir(bytecode_cache):
+            try:
+                os.makedirs(bytecode_cache)
+            except OSError:  # Another worker got there first.
+                if not os.path.isdir(bytecode_cache):
+                    raise
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache)
+    timings.enabled = bool(app.config.get("MD_TIMING"))
+    render_cache.directory = app.config.get("MD_RENDER_CACHE")
+    if app.config.get("MD_WATCH"):
+        Watcher(app.config["MD_FILES"],
+            os.path.join(app.root_path, app.template_folder),
+            app.config["MD_WATCH"], app.config.get("MD_ATOM_ITEMS", 20),
+            app.logger.info).start()
+
+@app.before_request
+def start_timing():
+    if timings.enabled:
+        timings.start_request()
+
+@app.after_request
+def add_server_timing(response):
+    phases = timings.finish_request() if timings.enabled else None
+    if phases:
+        response.headers["Server-Timing"] = ", ".join(
+            "%s;dur=%.2f" % (name, ms) for name, ms in phases)
+    return response
+
+@app.route("/_stats")
+def stats():
+    if not timings.enabled:
+        return make_404()
+    return jsonify(phases=timings.stats(), caches={
+        "page": page_cache.stats(),
+        "gzip": gzip_cache.stats(),
+        "feed": feed_cache.stats(),
+        "fragment": fragment_cache.stats(),
+        "render": render_cache.stats(),
+    })
+
+@app.route("/search")
+def search():
+    query = request.args.get("q", u"")
+    site = SearchIndex.for_path(app.config["MD_FILES"])
+    results = []
+    if site is not None and query:
+        results = site.search(query, app.config.get("MD_SEARCH_RESULTS", 20))
+    return render_template("_search.html", query=query, results=results)
+
+@app.route("/api/page/", defaults={"sub_path": ""})
+@app.route("/api/page/<path:sub_path>")
+def api_page(sub_path):
+    if sub_path.endswith(".md"):
+        return make_404()
+    page = get_page(os.path.join(app.config["MD_FILES"], sub_path or "index"))
+    if page is None:
+        return make_404()
+    return jsonify(public(page, body=page["body"]))
+
+@app.route("/api/nav/", defaults={"sub_path": ""})
+@app.route("/api/nav/<path:sub_path>")
+def api_nav(sub_path):
+    page = get_page(os.path.join(app.config["MD_FILES"], sub_path, "index"))
+    if page is None:
+        return make_404()
+    return ndjson(iter_nav(os.path.dirname(page["filename"])))
+
+@app.route("/api/export")
+def api_export():
+    return ndjson(iter_site(app.config["MD_FILES"]))
+
+@app.route("/sitemap.xml")
+def sitemap_index():
+    markdowns = os.path.abspath(app.config["MD_FILES"])
+    filename = os.path.join(markdowns, "_sitemap.xml")
+    if os.path.isfile(filename):
+        return send_file(filename, "application/xml", conditional=True)
+    # Without update-sitemap, the first 50,000 pages are listed as they go.
+    base = app.config.get("MD_SITE_URL", request.url_root).rstrip("/") + "/"
+    return Response(iter_urlset(base, iter_site(markdowns)),
+        mimetype="application/xml")
+
+@app.route("/sitemap-<name>.xml")
+def sitemap_shard(name):
+    filename = os.path.join(os.path.abspath(app.config["MD_FILES"]),
+        "_sitemap-%s.xml" % name)
+    if not name.isalnum() or not os.path.isfile(filename):
+        return make_404()
+    return send_file(filename, "application/xml", conditional=True)
+
 @app.route("/")
 def index():
     page = get_page(os.path.join(app.config["MD_FILES"], "index"))
     if page is None:
         return make_404()
-    context = make_context(page)
-    return respond(context)
+    return respond_conditionally(page)
 
 @app.route("/<path:sub_path>")
 def subsidiary_page(sub_path):
@@ -33,19 +248,26 @@ def subsidiary_page(sub_path):
     page = get_page(os.path.join(app.config["MD_FILES"], sub_path))
     if page is None:
         return make_404()
-    context = make_context(page)
-    return respond(context)
+    return respond_conditionally(page)
 
 @app.route("/atom")
 def atom_feed():
-    #info, entries = make_feed(app.config["MD_FILES"],
-    #    app.config.get("MD_ATOM_ITEMS", 20))
-    #return render_template("_atom.rss", info=info, entries=entries), 200, \
-    #    {"content-type": "application/atom+xml; coding=utf-8"}
+    markdowns = app.config["MD_FILES"]
+    limit = app.config.get("MD_ATOM_ITEMS", 20)
+    template = os.path.join(app.root_path, app.template_folder, "_atom.rss")
+    if not os.path.isfile(template):
+        return make_404()
+    mtimes = feed_mtimes(markdowns) + [os.path.getmtime(template)]
+    key = (limit, tuple(mtimes))
+    def render():
+        atom = feed_cache.get(key)
+        if atom is None:
+            info, entries = make_feed(markdowns, None, limit)
+            atom = render_template("_atom.rss", info=info, entries=entries)
+            feed_cache.put(key, atom)
+        return atom
     try:
-        atom = render_template("atom.rss")
-        return atom, 200, {"content-type": "application/atom+xml; coding=utf-8"}
+        return conditional(markdowns, mtimes, render,
+            "application/atom+xml; coding=utf-8")
     except:
         return make_404()
-
-
@@ -1,11 +1,37 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import json
+import hashlib
 from argparse import ArgumentParser
-from datetime import datetime
-from jinja2 import Environment
-from time import sleep
-from .helpers import make_nav_cache, make_feed
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from flask import render_template
+from . import app, respond
+from .search import build_index
+from .siteindex import SiteIndex, markdown_root
+from .sitemap import write_sitemap
+from .snapshot import Snapshot
+from .helpers import find_stale_dirs, get_mtimes, get_page, make_context, \
+    make_nav, make_feed, read_manifest, update_nav_cache, write_atomic, \
+    write_feed, write_manifest
+from .watcher import Watcher
+
+def _build_page(job):
+    # Runs in a worker process; app is already configured by the parent.
+    source, target = job
+    page = get_page(source)
+    with app.test_request_context("/%s" % page["path"]):
+        html = respond(make_context(page))
+    if not isinstance(html, basestring):
+        return source, target, False
+    write_atomic(target, html)
+    return source, target, True
+
+def _update_nav_cache(path):
+    if update_nav_cache(path):
+        return "* Updated _nav_cache at %s\n" % path
+    return "* Removed %s from the site index\n" % path
 
 class Commands:
     
@@ -28,7 +54,7 @@ class Commands:
     
     def _make_args_from_shell(self):
         cmds = sorted([x.replace("_", "-") for x in dir(self) \
-            if x.startswith("make") or x.startswith("update")])
+            if x.startswith(("build", "make", "update", "watch"))])
         ap = ArgumentParser()
         ap.add_argument("command",
             help="command must be one of: %s" % ", ".join(cmds))
@@ -37,12 +63,19 @@ class Commands:
         ap.add_argument("-t", "--title", help="title string")
         ap.add_argument("-k", "--keywords", help="keywords and key phrases")
         ap.add_argument("-l", "--limit", type=int, help="maximum items")
+        ap.add_argument("-o", "--output", help="path to output directory")
+        ap.add_argument("-u", "--url", help="base URL of the website")
+        ap.add_argument("--templates", help="path to templates directory")
+        ap.add_argument("-w", "--workers", type=int,
+            help="number of worker processes")
+        ap.add_argument("-s", "--seconds", type=float,
+            help="seconds between checks")
         ap.add_argument("-i", "--info", action="store_true",
             help="only print information about the command")
         self.args = ap.parse_args()
     
-    def _make_stamps(self):
-        d = datetime.utcnow()
+    def _make_stamps(self, d=None):
+        d = d or datetime.utcnow()
         ts = d.strftime("%Y-%m-%dT%H:%M:%SZ")
         ds = d.strftime("%A, %d %B %Y - %H:%M:%S")
         return ts, ds
@@ -68,6 +101,88 @@ class Commands:
         else:
             sys.exit("Unknown command %s.\n" % command)
     
+    def _build_jobs(self, markdowns, templates, output):
+        jobs = dict()
+        for dirname, subdirs, files in os.walk(markdowns):
+            if "index.md" not in files:
+                continue
+            # Nav caches must exist before the workers fork.
+            make_nav(dirname)
+            for x in files:
+                if x.startswith("_") or not x.endswith(".md"):
+                    continue
+                source = os.path.join(dirname, x)
+                page = get_page(source)
+                if page is None:
+                    continue
+                if x == "index.md":
+                    target = os.path.join(output, page["path"], "index.html")
+                else:
+                    target = os.path.join(output, "%s.html" % page["path"])
+                jobs[target] = (source, get_mtimes(page, templates))
+        return jobs
+    
+    def build(self):
+        """Renders every page and the ATOM feed to static HTML files. Only
+        pages whose source, nav cache, parent index or template changed since
+        the last build are rendered again.
+        
+        Requires:
+            --path - path to the site's markdown directory
+            --directory - path to the templates directory
+            --output - path to the output directory
+        
+        Optional:
+            --limit <int> maximum number of feed entries to include
+            --workers <int> number of worker processes
+        """
+        self._check_args("path", "directory", "output")
+        markdowns = os.path.realpath(self.args.path)
+        output = os.path.realpath(self.args.output)
+        app.config.update(MD_FILES=markdowns)
+        app.template_folder = os.path.realpath(self.args.directory)
+        # The manifest stays out of the public output directory.
+        manifest_file = os.path.join(markdowns, "_build_manifest-%s" % \
+            hashlib.sha1(output).hexdigest()[:12])
+        manifest = dict()
+        for x in (manifest_file, os.path.join(output, "_build_manifest")):
+            if os.path.isfile(x):
+                with open(x) as f:
+                    manifest = json.loads(f.read())
+                break
+        jobs = self._build_jobs(markdowns, app.template_folder, output)
+        todo = [(source, target) for target, (source, sig) in jobs.items() \
+            if manifest.get(target) != sig or not os.path.isfile(target)]
+        pool = Pool(self.args.workers or None)
+        try:
+            for source, target, ok in \
+                pool.imap_unordered(_build_page, todo, 16):
+                if ok:
+                    sys.stdout.write("* %s rendered.\n" % source)
+                else:  # Leave it out of the manifest so it is retried.
+                    sys.stdout.write("* %s failed to render.\n" % source)
+                    del jobs[target]
+        finally:
+            pool.close()
+            pool.join()
+        for target in set(manifest) - set(jobs):
+            if os.path.isfile(target):
+                os.remove(target)
+        # The feed depends on every page, so it is always rendered.
+        info, entries = make_feed(markdowns, None, self.args.limit or 25)
+        # Written as "atom", where the pages' url_for("atom_feed") points.
+        with app.test_request_context("/atom"):
+            write_atomic(os.path.join(output, "atom"),
+                render_template("_atom.rss", info=info, entries=entries))
+        write_atomic(manifest_file,
+            json.dumps(dict((t, sig) for t, (s, sig) in jobs.items())))
+        old_manifest = os.path.join(output, "_build_manifest")
+        if os.path.isfile(old_manifest):  # Written there by older builds.
+            os.remove(old_manifest)
+        sys.stdout.write("%d of %d pages rendered to %s. Goodbye.\n" % \
+            (len(todo), len(jobs), output))
+        sys.exit()
+    
     def make_page(self):
         """Creates a new page or replaces an existing one.
         
@@ -113,52 +228,99 @@ class Commands:
         sys.exit()
     
     def make_series(self):
-        """Creates a series of .md files based on images in static.
+        """Creates a series of .md files based on images in static, then
+        updates the nav cache of the --path directory.
         
         Requires:
             --path - path to where new .md files will be saved
             --directory - path to static folder containing image series
             --title - title of the series
             --keywords - keywords and key phrases
+        
+        Optional:
+            --templates - path to the templates directory; causes the ATOM
+                          feed to be updated as well
+            --limit <int> maximum number of feed entries to include
         """
         self._check_args("path", "directory", "title", "keywords")
         mds = os.path.realpath(self.args.path)
         img = os.path.realpath(self.args.directory)
         if not os.path.isdir(mds) or not os.path.isdir(img):
             sys.exit("Path or directory does not exist.")
-        imgs = sorted([x for x in os.listdir(img) if self._is_series_image(x)])
-        for i in imgs:
+        # One listing of each directory instead of a stat per file.
+        images = set(os.listdir(img))
+        existing = set(os.listdir(mds))
+        imgs = sorted([x for x in images if self._is_series_image(x) and \
+            "%s.md" % os.path.splitext(x)[0] not in existing],
+            key=lambda x: int(os.path.splitext(x)[0]))
+        # Pages get timestamps one second apart, after every page already
+        # in the directory, so the series stays in order across runs.
+        start = datetime.utcnow()
+        for x in existing:
+            page = get_page(os.path.join(mds, x)) if x.endswith(".md") \
+                else None
+            try:
+                ts = datetime.strptime(page["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
+            except (TypeError, ValueError):
+                continue
+            start = max(start, ts + timedelta(seconds=1))
+        for n, i in enumerate(imgs):
             f, e = os.path.splitext(i)
             item_num = unicode(int(f) + 1)
             md = os.path.join(mds, "%s.md" % f)
-            if not os.path.isfile(md):
-                timestamp, datestamp = self._make_stamps()
-                img = os.path.join(self.args.directory, i)
-                thmb = os.path.join(self.args.directory, "%s-thumb%s" % (f, e))
-                thumbnail = "/%s" % thmb if os.path.isfile(thmb) else ""
-                page = [
-                    u"Title: %s, Page %s" % (self.args.title, item_num),
-                    u"Description: Page %s of %s. Created on %s." % \
-                        (item_num, self.args.title, datestamp),
-                    u"Keywords: %s" % self.args.keywords,
-                    u"Template: ",
-                    u"Image: /%s" % img,
-                    u"Thumbnail: %s" % thumbnail,
-                    u"Timestamp: %s" % timestamp,
-                    u"Date: %s" % datestamp,
-                    u"Weight: %s" % item_num,
-                    u"Body: ",
-                ]
-                with open(md, "w") as f:
-                    f.write(u"\n".join(page).encode("utf-8"))
-                    sys.stdout.write("* %s saved.\n" % md)
-                sleep(5)
-        # Update caches.
-        sys.stdout.write("Better run the update-caches command as well. Bye.\n")
+            timestamp, datestamp = \
+                self._make_stamps(start + timedelta(seconds=n))
+            image = os.path.join(self.args.directory, i)
+            thmb = "%s-thumb%s" % (f, e)
+            thumbnail = "/%s" % os.path.join(self.args.directory, thmb) \
+                if thmb in images else ""
+            page = [
+                u"Title: %s, Page %s" % (self.args.title, item_num),
+                u"Description: Page %s of %s. Created on %s." % \
+                    (item_num, self.args.title, datestamp),
+                u"Keywords: %s" % self.args.keywords,
+                u"Template: ",
+                u"Image: /%s" % image,
+                u"Thumbnail: %s" % thumbnail,
+                u"Timestamp: %s" % timestamp,
+                u"Date: %s" % datestamp,
+                u"Weight: %s" % item_num,
+                u"Body: ",
+            ]
+            with open(md, "w") as f:
+                f.write(u"\n".join(page).encode("utf-8"))
+                sys.stdout.write("* %s saved.\n" % md)
+        if imgs:
+            if update_nav_cache(mds):
+                sys.stdout.write("_nav_cache has been saved.\n")
+            if self.args.templates:
+                write_feed(markdown_root(mds), self.args.templates,
+                    self.args.limit or 25)
+                sys.stdout.write("Atom feed has been updated.\n")
+        else:
+            sys.stdout.write("No new images found.\n")
+        sys.exit()
+    
+    def make_snapshot(self):
+        """Saves every page, rendered, with the nav and feed data of the
+        whole site to a single file for the MD_SNAPSHOT setting.
+        
+        Requires:
+            --path - path to the site's markdown directory
+            --output - path to the snapshot file
+        """
+        self._check_args("path", "output")
+        site = Snapshot.build(self.args.path)
+        site.save(self.args.output)
+        sys.stdout.write("%d pages saved to %s. Goodbye.\n" % \
+            (len(site.pages), self.args.output))
         sys.exit()
     
     def update_caches(self):
-        """Updates the _nav_cache files in all markdown directories.
+        """Updates the _nav_cache files in markdown directories whose pages
+        changed since the last run, according to the _caches_manifest file
+        in the markdown directory. Delete that file to update everything.
+        Also creates the _site_index file used for nav and feed lookups.
         
         Requires:
             --path - path to the site's markdown directory
@@ -168,13 +330,27 @@ class Commands:
                            update-feed to be called as well
             --limit <int>  maximum number of entries to include; works only
                            if --directory is supplied
+            --workers <int> number of worker processes
         """
         self._check_args("path")
-        for dirname, subdirs, files in os.walk(self.args.path):
-            if "index.md" in files:
-                sys.stdout.write("* Updating _nav_cache at %s\n" % dirname)
-                make_nav_cache(dirname)
-        sys.stdout.write("_nav_cache files have been saved.\n")
+        markdowns = os.path.realpath(self.args.path)
+        stale, manifest = find_stale_dirs(markdowns, read_manifest(markdowns))
+        if len(stale) > 1:
+            pool = Pool(self.args.workers or None)
+            try:
+                for message in pool.imap_unordered(_update_nav_cache, stale):
+                    sys.stdout.write(message)
+            finally:
+                pool.close()
+                pool.join()
+        elif stale:
+            sys.stdout.write(_update_nav_cache(stale[0]))
+        write_manifest(markdowns, manifest)
+        sys.stdout.write("%d _nav_cache files have been saved.\n" % len(stale))
+        # Once it exists, make_nav_cache keeps the site index up to date.
+        if SiteIndex.for_path(markdowns) is None:
+            SiteIndex(markdowns).build()
+            sys.stdout.write("_site_index has been created.\n")
         if self.args.directory:
             self.update_feed()
         sys.exit()
@@ -190,18 +366,38 @@ class Commands:
             --limit <int> maximum number of entries to include
         """
         self._check_args("path", "directory")
-        if not self.args.limit:
-            self.args.limit = 25
-        info, entries = make_feed(self.args.path, self.args.limit)
-        # Render the template to a file.
-        with open(os.path.join(self.args.directory, "_atom.rss")) as f:
-            template = f.read().decode("utf-8")
-        env = Environment().from_string(template)
-        with open(os.path.join(self.args.directory, "atom.rss"), "w") as f:
-            f.write(env.render(info=info, entries=entries).encode("utf-8"))
+        write_feed(self.args.path, self.args.directory, self.args.limit or 25)
         sys.stdout.write("Atom feed has been updated. Goodbye.\n")
         sys.exit()
     
+    def update_index(self):
+        """Builds the _search_index file used by the /search page out of
+        every page's title, description, keywords and body.
+        
+        Requires:
+            --path - path to the site's markdown directory
+        """
+        self._check_args("path")
+        pages, terms = build_index(self.args.path)
+        sys.stdout.write("%d pages and %d terms indexed. Goodbye.\n" % \
+            (pages, terms))
+        sys.exit()
+    
+    def update_sitemap(self):
+        """Writes the sitemap served at /sitemap.xml: a sitemap index and
+        shards of up to 50,000 page URLs each, made from the _nav_cache
+        files. Only shards whose directories changed are written again.
+        
+        Requires:
+            --path - path to the site's markdown directory
+            --url - the website's base URL, e.g. http://www.example.com/
+        """
+        self._check_args("path", "url")
+        written, shards = write_sitemap(self.args.path, self.args.url)
+        sys.stdout.write("%d of %d sitemap shards have been written. "
+            "Goodbye.\n" % (written, shards))
+        sys.exit()
+    
     def update_page(self):
         """Updates the Timestamp and Date values of a page. Use this command
         after updating a page's content in a text editor.
@@ -226,6 +422,29 @@ class Commands:
             f.write(lines.encode("utf-8"))
             f.truncate()
         sys.stdout.write("* %s has been updated.\n" % self.args.path)
-        make_nav_cache(os.path.dirname(self.args.path))
+        update_nav_cache(os.path.dirname(self.args.path))
         sys.exit()
-
+    
+    def watch(self):
+        """Watches the markdown directory for changes and updates the
+        _nav_cache files of changed directories, as well as the ATOM feed if
+        --directory is supplied. Edits made in quick succession are applied
+        together. Stop with Ctrl+C.
+        
+        Requires:
+            --path - path to the site's markdown directory
+        
+        Optional:
+            --directory - path to the templates directory
+            --limit <int> maximum number of feed entries to include
+            --seconds <float> seconds between checks; defaults to 2
+        """
+        self._check_args("path")
+        w = Watcher(self.args.path, self.args.directory,
+            self.args.seconds or 2.0, self.args.limit or 25,
+            lambda message: sys.stdout.write("%s\n" % message))
+        sys.stdout.write("Watching %s.\n" % w.markdowns)
+        try:
+            w.run()
+        except KeyboardInterrupt:
+            sys.exit("Goodbye.")
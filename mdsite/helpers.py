@@ -1,7 +1,176 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import json
+import hashlib
+import heapq
+from collections import OrderedDict
+from contextlib import contextmanager
+from operator import attrgetter
+from threading import Lock, current_thread
+import markdown as markdown_module
+from jinja2 import Environment
 from markdown import markdown
+from .siteindex import Entry, SiteIndex, nav_from_json, nav_to_json
+from .timing import timings
+
+try:
+    import fcntl
+except ImportError:  # Not on Unix; only threads get coordinated.
+    fcntl = None
+
+class LRUCache(object):
+    
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def get(self, key, validator=None):
+        # A stored value is only good if its validator still matches.
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] != validator:
+                self.misses += 1
+                return None
+            self._data[key] = item
+            self.hits += 1
+            return item[1]
+    
+    def put(self, key, value, validator=None):
+        with self._lock:
+            self._data.pop(key, None)
+            if self.maxsize > 0:
+                self._data[key] = (validator, value)
+            self._evict()
+    
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+    
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize,
+            "hits": self.hits, "misses": self.misses}
+    
+    def _evict(self):
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+
+# Keyword arguments for every markdown() call.
+MARKDOWN_OPTIONS = {"extensions": []}
+
+class RenderCache(object):
+    """Rendered markdown bodies on disk, keyed by a hash of the markdown
+    source, the markdown version and MARKDOWN_OPTIONS. Entries are written
+    to a temporary file and renamed into place, so any number of processes
+    can share the directory. Does nothing while directory is None."""
+    
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        version = getattr(markdown_module, "__version__", "")
+        if not isinstance(version, basestring):  # Markdown 2.x
+            version = markdown_module.version
+        self._salt = json.dumps([version, MARKDOWN_OPTIONS], sort_keys=True)
+    
+    def _filename(self, source):
+        key = hashlib.sha1(self._salt + source.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key[2:])
+    
+    def get(self, source):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._filename(source)) as f:
+                html = f.read().decode("utf-8")
+        except IOError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return html
+    
+    def put(self, source, html):
+        if self.directory is None:
+            return
+        try:
+            write_atomic(self._filename(source), html)
+        except (IOError, OSError):  # The page still has its body.
+            pass
+    
+    def stats(self):
+        return {"directory": self.directory, "hits": self.hits,
+            "misses": self.misses}
+
+render_cache = RenderCache()
+
+class _Body(object):
+    
+    def __init__(self, source):
+        self.source = source
+        self.html = None
+    
+    def render(self):
+        if self.html is None:
+            self.html = render_cache.get(self.source)
+        if self.html is None:
+            with timings.phase("markdown"):
+                self.html = markdown(self.source, **MARKDOWN_OPTIONS)
+            render_cache.put(self.source, self.html)
+        return self.html
+
+class Page(dict):
+    """A page's metadata. The "body" item is only rendered from markdown the
+    first time it is looked up, and copies share that rendering."""
+    
+    _body = None
+    
+    def __missing__(self, key):
+        if key != "body":
+            raise KeyError(key)
+        value = self._body.render() if self._body is not None else None
+        self[key] = value
+        return value
+    
+    def copy(self):
+        page = Page(self)
+        page._body = self._body
+        return page
+    
+    def get(self, key, default=None):
+        if key == "body":
+            return self[key]
+        return dict.get(self, key, default)
+
+_HEADER_KEYS = dict((t.title(), t) for t in ("title", "description",
+    "keywords", "timestamp", "date", "image", "thumbnail", "template",
+    "weight"))
+
+# Parsed pages, keyed by real path and validated by mtime and size.
+page_cache = LRUCache(256)
+# The preloaded Snapshot of the whole site, when the app serves from one.
+snapshot = None
+# Per-directory locks for building _nav_cache files.
+_nav_locks = dict()
+_nav_locks_lock = Lock()
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
 
 def _to_int(value, on_except=0):
     try:
@@ -10,9 +179,117 @@ def _to_int(value, on_except=0):
         v = on_except
     return v
 
+def _dependent_dirs(filename):
+    # An index.md shows up in its own directory, in its parent's folders and
+    # as the up level of its subdirectories' index pages.
+    d = os.path.dirname(filename)
+    if os.path.basename(filename) != "index.md":
+        return [d]
+    subdirs = [os.path.join(d, x) for x in os.listdir(d)] \
+        if os.path.isdir(d) else []
+    return [d, os.path.dirname(d)] + [x for x in subdirs if os.path.isdir(x)]
+
+@contextmanager
+def _file_lock(filename):
+    if fcntl is None:
+        yield
+        return
+    with open(filename, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _walk_feed(markdowns, limit):
+    # Pages will be the atom entries, newest first.
+    return heapq.nlargest(limit, _walk_nav_files(markdowns),
+        key=attrgetter("timestamp"))
+
+def _walk_nav_files(markdowns):
+    # One directory's nav data is held in memory at a time.
+    for dirname, subdirs, files in os.walk(markdowns):
+        if "_nav_cache" in files:
+            with open(os.path.join(dirname, "_nav_cache")) as f:
+                data = nav_from_json(f.read())
+            for x in data["files"]:
+                yield x
+
+def feed_mtimes(markdowns):
+    """Returns mtimes that change whenever a page that could be in the feed
+    does: the site index's last update, or every _nav_cache's mtime."""
+    if snapshot is not None:
+        return [snapshot.created]
+    site_index = SiteIndex.for_path(markdowns)
+    if site_index is not None:
+        return [site_index.updated()]
+    return [_mtime(os.path.join(d, "_nav_cache")) \
+        for d, subdirs, files in os.walk(markdowns) if "_nav_cache" in files]
+
+def find_stale_dirs(markdowns, manifest):
+    """Compares the markdown tree with a manifest of [mtime, size, sha1] per
+    source file. Returns the directories whose _nav_cache has to be rebuilt
+    or that are gone, and the manifest for the tree as it is now."""
+    if isinstance(markdowns, str):
+        markdowns = markdowns.decode(sys.getfilesystemencoding())
+    stale = set()
+    current = dict()
+    for dirname, subdirs, files in os.walk(markdowns):
+        if "index.md" not in files:
+            continue
+        if "_nav_cache" not in files:
+            stale.add(dirname)
+        for x in files:
+            if x.startswith("_") or not x.endswith(".md"):
+                continue
+            fn = os.path.join(dirname, x)
+            st = os.stat(fn)
+            old = manifest.get(fn)
+            # Only hash files whose mtime or size moved.
+            if old and old[0] == st.st_mtime and old[1] == st.st_size:
+                current[fn] = old
+                continue
+            current[fn] = [st.st_mtime, st.st_size, _file_hash(fn)]
+            if not old or old[2] != current[fn][2]:
+                stale.update(_dependent_dirs(fn))
+    for fn in set(manifest) - set(current):
+        stale.update(_dependent_dirs(fn))
+    # Directories that lost their index.md are returned too, so that
+    # update_nav_cache can drop them from the site index.
+    stale = [d for d in stale if os.path.isfile(os.path.join(d, "index.md")) \
+        or os.path.join(d, "index.md") in manifest]
+    return sorted(stale), current
+
+def get_mtimes(page, templates):
+    """Returns the mtimes of everything a rendered page depends on: its
+    source, its directory's _nav_cache, its parent index.md, its template
+    and _nav.html."""
+    template = os.path.join(templates, page["template"] or "")
+    if not os.path.isfile(template):
+        template = os.path.join(templates, "_failsafe.html")
+    nav_template = _mtime(os.path.join(templates, "_nav.html"))
+    if snapshot is not None:
+        return [snapshot.created, _mtime(template), nav_template]
+    d = os.path.dirname(page["filename"])
+    if page["filename"].endswith("index.md"):
+        parent = os.path.join(os.path.dirname(d), "index.md")
+    else:
+        parent = os.path.join(d, "index.md")
+    return [_mtime(page["filename"]), _mtime(os.path.join(d, "_nav_cache")),
+        _mtime(parent), _mtime(template), nav_template]
+
 def get_page(requested_path):
     if "./" in requested_path:
         return None
+    if snapshot is not None:
+        return snapshot.get_page(requested_path)
     if os.path.isdir(requested_path):
         requested_path = os.path.join(requested_path, "index")
     if not requested_path.endswith(".md"):
@@ -23,9 +300,22 @@ def get_page(requested_path):
     rp = requested_path.split("markdown/")
     if len(rp) < 2:
         return None
-    page = {
-        "filename": unicode(os.path.realpath(requested_path)),
-        "path": unicode(rp[-1]),
+    filename = unicode(os.path.realpath(requested_path))
+    path = unicode(rp[-1])
+    if path.endswith("index.md"):
+        path = path[:0 - len("index.md")]
+    if path.endswith(".md"):
+        path = path[:0 - len(".md")]
+    st = os.stat(filename)
+    validator = (st.st_mtime, st.st_size)
+    cached = page_cache.get(filename, validator)
+    if cached is not None:
+        page = cached.copy()
+        page["path"] = path
+        return page
+    page = Page({
+        "filename": filename,
+        "path": path,
         "title": u"Generic, Untitled Page",
         "description": u"No description available.",
         "keywords": u"keywords, key phrases",
@@ -35,42 +325,48 @@ def get_page(requested_path):
         "thumbnail": None,
         "template": None,
         "weight": 0,
-        "body": None,
-    }
-    with open(page["filename"]) as f:
-        for line in f.readlines():
-            line = line[:-1].decode("utf-8")
-            if page["body"] is not None:
-                page["body"] += u"%s\n" % line
-            for t in page.keys():
-                tk = "%s:" % t.title()
-                v = line[len(tk) + 1:]
-                if line.startswith(tk) and len(line) > 1:
-                    if t == "weight":
-                        page[t] = _to_int(v, 0)
-                    else:
-                        page[t] = v
-    if page["body"] is not None:
-        page["body"] = markdown(page["body"])
-    if page["path"].endswith("index.md"):
-        page["path"] = page["path"][:0 - len("index.md")]
-    if page["path"].endswith(".md"):
-        page["path"] = page["path"][:0 - len(".md")]
+    })
+    body = None
+    with timings.phase("parse"), open(filename) as f:
+        for line in f:
+            line = line.rstrip("\n").decode("utf-8")
+            if body is not None:
+                body.append(line)
+                continue
+            # Header lines look like "Key: value"; stop matching at Body:.
+            k, colon, v = line.partition(":")
+            if not colon:
+                continue
+            if k == "Body":
+                body = [v[1:]]
+            elif k in _HEADER_KEYS:
+                t = _HEADER_KEYS[k]
+                page[t] = _to_int(v[1:], 0) if t == "weight" else v[1:]
+    if body is not None:
+        page._body = _Body(body[0] + u"".join(u"%s\n" % x for x in body[1:]))
+    page_cache.put(filename, page.copy(), validator)
     return page
 
-def get_previous_next(page, files):
+def get_previous_next(page, files, positions=None, offset=0):
     previous = None
     next = None
     current_index = None
     # Makes no sense going further if we have no files or we're using index.md.
     if not files or page["filename"].endswith("index.md"):
         return previous, next, current_index
-    current_index = files.index([x for x in files \
-        if x["filename"] == page["filename"]][0])
-    if current_index > 0: 
-        previous = files[current_index - 1] 
-    if (current_index + 1) < len(files):
-        next = files[current_index + 1]
+    if positions is not None:
+        current_index = positions.get(page["filename"])
+        if current_index is None:  # Not in the nav cache yet.
+            return previous, next, current_index
+    else:
+        current_index = files.index([x for x in files \
+            if x["filename"] == page["filename"]][0])
+    # files may be a slice of the directory's files, starting at offset.
+    i = current_index - offset
+    if i > 0: 
+        previous = files[i - 1] 
+    if (i + 1) < len(files):
+        next = files[i + 1]
     return previous, next, current_index
 
 def get_up_level(page):
@@ -78,6 +374,11 @@ def get_up_level(page):
         d = os.path.realpath(os.path.dirname(os.path.dirname(page["filename"])))
     else:
         d = os.path.realpath(os.path.dirname(page["filename"]))
+    site_index = SiteIndex.for_path(d)
+    if site_index is not None:
+        up_level = site_index.up_level(d)
+        if up_level is not None:
+            return up_level
     df = os.path.join(d, "index.md")
     if os.path.isfile(df):
         return get_page(os.path.join(d, "index"))
@@ -86,15 +387,13 @@ def get_up_level(page):
 def make_feed(markdowns, atom_template, limit=20):
     # Get some info from the main index page.
     index_page = get_page(os.path.join(markdowns, "index"))
-    # Pages will be the atom entries.
-    pages = []
-    for dirname, subdirs, files in os.walk(markdowns):
-        if "_nav_cache" in files:
-            with open(os.path.join(dirname, "_nav_cache")) as f:
-                data = json.loads(f.read())
-                pages += data["files"]
-    # Sort the pages according to creation date and trim the list.
-    pages = sorted(pages, key=lambda x:x["timestamp"], reverse=True)[:limit]
+    site_index = SiteIndex.for_path(markdowns)
+    if snapshot is not None:
+        pages = snapshot.feed[:limit]
+    elif site_index is not None:
+        pages = site_index.feed(limit)
+    else:
+        pages = _walk_feed(markdowns, limit)
     if pages:  # Update the index_page information for the feed.
         if pages[0]["timestamp"] and pages[0]["date"]:
             index_page["timestamp"] = pages[0]["timestamp"]
@@ -107,26 +406,161 @@ def make_404():
 def make_500():
     return "500 Internal Server Error", 500, {"content-type": "text-plain"}
 
-def make_context(page):
+def make_context(page, nav_page=None, page_size=None, window=None):
+    """Index pages list page_size files per nav page when page_size is
+    given; other pages list the window files before and after them when
+    window is given. Otherwise every file is listed."""
     c = dict()
     path = os.path.dirname(page["filename"])
     c["page"] = page
-    c["folders"], c["files"] = make_nav(path)
+    c["nav_page"] = c["nav_pages"] = 1
+    is_index = page["filename"].endswith("index.md")
+    if is_index and page_size:
+        c["nav_page"] = max(nav_page or 1, 1)
+        start = (c["nav_page"] - 1) * page_size
+        nav = load_nav_slice(path, start, start + page_size)
+        c["nav_pages"] = max((nav["count"] + page_size - 1) // page_size, 1)
+        if c["nav_page"] > c["nav_pages"]:  # Past the end; show the last.
+            c["nav_page"] = c["nav_pages"]
+            start = (c["nav_page"] - 1) * page_size
+            nav = load_nav_slice(path, start, start + page_size)
+    elif window and not is_index:
+        nav = load_nav_window(path, page["filename"], window)
+    else:
+        nav = load_nav(path)
+    c["folders"], c["files"] = nav["folders"], nav["files"]
+    c["nav_offset"] = nav.get("offset", 0)
     c["previous_page"], c["next_page"], c["current_index"] = \
-        get_previous_next(page, c["files"])
-    c["up_level"] = get_up_level(page)
+        get_previous_next(page, c["files"], nav["positions"], c["nav_offset"])
+    if is_index:
+        c["up_level"] = nav["up"]
+    else:
+        c["up_level"] = nav["index"]
     return c
 
-def make_nav(path):
+def load_nav(path):
+    """Returns a directory's nav data: its "folders" and "files", the
+    "positions" of its files by filename, and the metadata of its own
+    index.md ("index") and of its parent directory's ("up")."""
+    with timings.phase("nav"):
+        return _load_nav(path)
+
+def load_nav_slice(path, start, stop):
+    """Returns load_nav's data with only files[start:stop] in "files",
+    plus the slice's "offset" and the "count" of all files. With a site
+    index only the slice is read."""
+    with timings.phase("nav"):
+        site_index = SiteIndex.for_path(path) if snapshot is None else None
+        if site_index is not None:
+            nav = site_index.load_nav(path, start, stop)
+            if nav is not None:
+                return nav
+        return _nav_slice(_load_nav(path), start, stop)
+
+def load_nav_window(path, filename, window):
+    """Returns load_nav_slice's data for the window files before and after
+    filename, reading the nav data only once."""
+    with timings.phase("nav"):
+        site_index = SiteIndex.for_path(path) if snapshot is None else None
+        if site_index is not None:
+            position = site_index.position(path, filename)
+            if position is not None:
+                nav = site_index.load_nav(path, max(position - window, 0),
+                    position + window + 1)
+                if nav is not None:
+                    return nav
+        nav = _load_nav(path)
+        position = nav["positions"].get(filename) or 0
+        return _nav_slice(nav, max(position - window, 0),
+            position + window + 1)
+
+def _nav_slice(nav, start, stop):
+    return dict(nav, files=nav["files"][start:stop], offset=start,
+        count=len(nav["files"]))
+
+def iter_nav(path):
+    """Yields ("index", entry), then ("folder", entry) and ("file", entry)
+    pairs for a directory. With a site index the entries are read as they
+    are consumed instead of all at once."""
+    site_index = SiteIndex.for_path(path) if snapshot is None else None
+    if site_index is not None and site_index.up_level(path) is not None:
+        return site_index.iter_nav(path)
+    return _iter_nav_data(load_nav(path))
+
+def _iter_nav_data(nav):
+    if nav["index"] is not None:
+        yield "index", nav["index"]
+    for x in nav["folders"]:
+        yield "folder", x
+    for x in nav["files"]:
+        yield "file", x
+
+def iter_site(markdowns):
+    """Yields iter_nav's pairs for every directory of a site, one
+    directory's nav data at a time."""
+    site_index = SiteIndex.for_path(markdowns) if snapshot is None else None
+    if site_index is not None:
+        for x in site_index.iter_site():
+            yield x
+    elif snapshot is not None:
+        for dirname in sorted(snapshot.navs):
+            for x in _iter_nav_data(snapshot.navs[dirname]):
+                yield x
+    else:
+        for dirname, subdirs, files in os.walk(markdowns):
+            subdirs.sort()
+            if "index.md" in files:
+                for x in _iter_nav_data(load_nav(dirname)):
+                    yield x
+
+def nav_mtime(path):
+    """Returns what changes whenever a directory's nav data does."""
+    if snapshot is not None:
+        return snapshot.created
+    return _mtime(os.path.join(path, "_nav_cache"))
+
+def _load_nav(path):
+    if snapshot is not None:
+        return snapshot.load_nav(path)
+    site_index = SiteIndex.for_path(path)
+    if site_index is not None:
+        nav = site_index.load_nav(path)
+        if nav is not None:
+            return nav
     # Do nothing if we already have a nav_cache.
+    data = _read_nav_cache(path)
+    if data is not None:
+        return data
+    # The other builders wait for the first one and read what it wrote.
+    with _nav_build_lock(path):
+        data = _read_nav_cache(path)
+        if data is None:
+            data = _make_nav_data(path)
+    return data
+
+@contextmanager
+def _nav_build_lock(path):
+    # One builder per directory, across threads and processes.
+    with _nav_locks_lock:
+        lock = _nav_locks.setdefault(os.path.realpath(path), Lock())
+    with lock, _file_lock(os.path.join(path, "_nav_cache.lock")):
+        yield
+
+def _read_nav_cache(path):
     nav_cache = os.path.join(path, "_nav_cache")
-    if os.path.isfile(nav_cache):
-        with open(nav_cache) as f:
-            data = json.loads(f.read())
-            return data["folders"], data["files"]
-    return make_nav_cache(path)
+    if not os.path.isfile(nav_cache):
+        return None
+    with open(nav_cache) as f:
+        data = nav_from_json(f.read())
+    if "positions" not in data:  # Older caches lack the links.
+        return None
+    return data
 
-def make_nav_cache(path):
+def make_nav(path):
+    nav = load_nav(path)
+    return nav["folders"], nav["files"]
+
+def _make_nav_data(path):
     folders = []
     files = []
     for x in os.listdir(path):
@@ -134,21 +568,109 @@ def make_nav_cache(path):
         info = None
         list_ = None
         if os.path.isdir(xp):
-            info = get_page(os.path.join(xp, "index.md"))
+            info = _nav_entry(os.path.join(xp, "index.md"))
             list_ = folders
         elif os.path.isfile(xp):
             if not x.startswith("_") and x.endswith(".md") and x != "index.md":
-                info = get_page(os.path.join(path, x))
+                info = _nav_entry(os.path.join(path, x))
                 list_ = files
         if info is not None and list_ is not None:
-            del info["body"]
-            del info["template"]
             list_.append(info)
     # Sort the folders and files according to weight, title, and path.
-    folders.sort(key=lambda x: (x["weight"], x["title"], x["path"]))
-    files.sort(key=lambda x: (x["weight"], x["title"], x["path"]))
-    with open(os.path.join(path, "_nav_cache"), "w") as f:
-        data = {"folders": folders, "files": files}
-        f.write(json.dumps(data))
-    return folders, files
+    key = attrgetter("weight", "title", "path")
+    folders.sort(key=key)
+    files.sort(key=key)
+    up = os.path.join(os.path.dirname(os.path.realpath(path)), "index.md")
+    data = {
+        "folders": folders,
+        "files": files,
+        "positions": dict((x["filename"], i) for i, x in enumerate(files)),
+        "index": _nav_entry(os.path.join(path, "index.md")),
+        "up": _nav_entry(up),
+    }
+    write_atomic(os.path.join(path, "_nav_cache"), nav_to_json(data))
+    site_index = SiteIndex.for_path(path)
+    if site_index is not None:
+        site_index.update_dir(path, data["index"], folders, files)
+    return data
+
+def make_nav_cache(path):
+    data = _make_nav_data(path)
+    return data["folders"], data["files"]
+
+def update_nav_cache(path):
+    """Rebuilds a directory's _nav_cache and returns True, or removes a
+    directory without an index.md from the site index and returns
+    False."""
+    if os.path.isfile(os.path.join(path, "index.md")):
+        with _nav_build_lock(path):
+            make_nav_cache(path)
+        return True
+    site_index = SiteIndex.for_path(path)
+    if site_index is not None:
+        site_index.remove_dir(path)
+    return False
+
+def _nav_entry(filename):
+    # The entry leaves the body and template behind.
+    return Entry.from_dict(get_page(filename))
+
+def read_manifest(markdowns):
+    manifest = os.path.join(markdowns, "_caches_manifest")
+    if not os.path.isfile(manifest):
+        return dict()
+    with open(manifest) as f:
+        return json.loads(f.read())
+
+def use_snapshot(site):
+    """Serves every page, nav and feed from site, a Snapshot, from now on.
+    None goes back to reading the markdown directory."""
+    global snapshot
+    snapshot = site
+
+@contextmanager
+def atomic_path(filename):
+    """Yields a temporary path to write filename's new contents to, then
+    renames it into place, so readers only ever see the old or the new
+    file. The temporary file is removed if the block fails."""
+    d = os.path.dirname(filename)
+    if d and not os.path.isdir(d):
+        try:
+            os.makedirs(d)
+        except OSError:  # Another process got there first.
+            pass
+    # Threads of one process each get their own temporary file too.
+    temp = "%s.%d.%d.tmp" % (filename, os.getpid(), current_thread().ident)
+    if os.path.isfile(temp):  # Left behind by a crash.
+        os.remove(temp)
+    try:
+        yield temp
+        os.rename(temp, filename)
+    except:
+        if os.path.isfile(temp):
+            os.remove(temp)
+        raise
+
+@contextmanager
+def atomic_file(filename, mode="w"):
+    """Like atomic_path, but yields the temporary file opened with mode."""
+    with atomic_path(filename) as temp:
+        with open(temp, mode) as f:
+            yield f
+
+def write_atomic(filename, text):
+    with atomic_file(filename) as f:
+        f.write(text.encode("utf-8"))
+
+def write_feed(markdowns, templates, limit=25):
+    info, entries = make_feed(markdowns, None, limit)
+    # Render the template to a file.
+    with open(os.path.join(templates, "_atom.rss")) as f:
+        template = f.read().decode("utf-8")
+    env = Environment().from_string(template)
+    write_atomic(os.path.join(templates, "atom.rss"),
+        env.render(info=info, entries=entries))
 
+def write_manifest(markdowns, manifest):
+    write_atomic(os.path.join(markdowns, "_caches_manifest"),
+        json.dumps(manifest))
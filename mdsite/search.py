@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import json
+import heapq
+import math
+import mmap
+import struct
+from array import array
+from threading import Lock
+from .helpers import atomic_file, get_page
+
+# Each field's words count this many times towards a page's term weights.
+FIELD_WEIGHTS = (("title", 5), ("keywords", 3), ("description", 2))
+K1 = 1.2
+B = 0.75
+
+_HEADER = struct.Struct("<4sIIf5I")
+_TERM = struct.Struct("<IIII")
+_DOC = struct.Struct("<III")
+_MAGIC = b"MDS1"
+_WORDS = re.compile(r"\w\w+", re.UNICODE)
+_instances = dict()
+_instances_lock = Lock()
+
+def tokenize(text):
+    return _WORDS.findall((text or u"").lower())
+
+def _postings(data):
+    a = array("I")
+    a.fromstring(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+def _packed(a):
+    if sys.byteorder == "big":
+        a = array("I", a)
+        a.byteswap()
+    return a.tostring()
+
+def build_index(markdowns):
+    """Writes _search_index to the markdown directory. The file holds a
+    sorted term dictionary, the postings of each term as packed
+    (page, weight) integer pairs and a table of page titles, descriptions
+    and paths, so queries never touch the markdown files."""
+    markdowns = os.path.realpath(markdowns)
+    terms = dict()
+    docs = []
+    lengths = []
+    for dirname, subdirs, files in os.walk(markdowns):
+        for x in sorted(files):
+            if x.startswith("_") or not x.endswith(".md"):
+                continue
+            page = get_page(os.path.join(dirname, x))
+            if page is None:
+                continue
+            weights = dict()
+            for field, weight in FIELD_WEIGHTS:
+                for t in tokenize(page[field]):
+                    weights[t] = weights.get(t, 0) + weight
+            # The markdown source is good enough for finding words.
+            body = page._body.source if page._body is not None else u""
+            for t in tokenize(body):
+                weights[t] = weights.get(t, 0) + 1
+            doc_id = len(docs)
+            for t, w in weights.items():
+                terms.setdefault(t.encode("utf-8"), array("I")).extend(
+                    (doc_id, w))
+            docs.append(json.dumps([page["path"], page["title"],
+                page["description"]]).encode("utf-8"))
+            lengths.append(sum(weights.values()))
+    sorted_terms = sorted(terms)
+    term_table = []
+    term_blob = []
+    postings = []
+    blob_offset = 0
+    post_offset = 0
+    for t in sorted_terms:
+        p = terms[t]
+        term_table.append(_TERM.pack(blob_offset, len(t), post_offset,
+            len(p) // 2))
+        term_blob.append(t)
+        postings.append(_packed(p))
+        blob_offset += len(t)
+        post_offset += len(p) * 4
+    doc_table = []
+    doc_offset = 0
+    for d, length in zip(docs, lengths):
+        doc_table.append(_DOC.pack(doc_offset, len(d), length))
+        doc_offset += len(d)
+    sections = [b"".join(term_table), b"".join(term_blob),
+        b"".join(postings), b"".join(doc_table), b"".join(docs)]
+    offsets = []
+    offset = _HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+    avgdl = float(sum(lengths)) / len(lengths) if lengths else 0.0
+    filename = os.path.join(markdowns, "_search_index")
+    with atomic_file(filename, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(sorted_terms), len(docs), avgdl,
+            *offsets))
+        for section in sections:
+            f.write(section)
+    return len(docs), len(sorted_terms)
+
+class SearchIndex(object):
+    """Answers queries from a memory-mapped _search_index file."""
+    
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._lock = Lock()
+        self._readers = 0
+        self._closing = False
+        (magic, self.n_terms, self.n_docs, self.avgdl, self.terms_off,
+            self.blob_off, self.postings_off, self.docs_off,
+            self.docs_blob_off) = _HEADER.unpack_from(self.mm, 0)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a search index." % filename)
+    
+    @classmethod
+    def for_path(cls, markdowns):
+        """Returns the search index of a site, or None if it has none. The
+        file is mapped again when update-index replaces it."""
+        filename = os.path.join(os.path.realpath(markdowns), "_search_index")
+        try:
+            ino = os.stat(filename).st_ino
+        except OSError:
+            return None
+        with _instances_lock:
+            ino_, instance = _instances.get(filename, (None, None))
+            if ino_ != ino:
+                if instance is not None:
+                    instance.close()
+                instance = cls(filename)
+                _instances[filename] = (ino, instance)
+        return instance
+    
+    def close(self):
+        """Unmaps the file once the searches still running are done."""
+        with self._lock:
+            self._closing = True
+            if not self._readers:
+                self.mm.close()
+    
+    def _find(self, term):
+        # Binary search over the sorted term dictionary.
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = _TERM.unpack_from(self.mm,
+                self.terms_off + mid * _TERM.size)
+            start = self.blob_off + entry[0]
+            found = self.mm[start:start + entry[1]]
+            if found < term:
+                lo = mid + 1
+            elif found > term:
+                hi = mid
+            else:
+                return entry
+        return None
+    
+    def _doc(self, doc_id):
+        offset, size, length = _DOC.unpack_from(self.mm,
+            self.docs_off + doc_id * _DOC.size)
+        start = self.docs_blob_off + offset
+        return json.loads(self.mm[start:start + size].decode("utf-8"))
+    
+    def _length(self, doc_id):
+        return _DOC.unpack_from(self.mm,
+            self.docs_off + doc_id * _DOC.size)[2]
+    
+    def search(self, query, limit=20):
+        """Returns the best matching pages for query, ranked with BM25, as
+        dicts of path, title, description and score."""
+        with self._lock:
+            self._readers += 1
+        try:
+            return self._search(query, limit)
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if self._closing and not self._readers:
+                    self.mm.close()
+    
+    def _search(self, query, limit):
+        scores = dict()
+        for t in set(tokenize(query)):
+            entry = self._find(t.encode("utf-8"))
+            if entry is None:
+                continue
+            count = entry[3]
+            idf = math.log(1 + (self.n_docs - count + 0.5) / (count + 0.5))
+            start = self.postings_off + entry[2]
+            p = _postings(self.mm[start:start + count * 8])
+            for i in range(0, len(p), 2):
+                doc_id, tf = p[i], p[i + 1]
+                norm = K1 * (1 - B + B * self._length(doc_id) / self.avgdl)
+                scores[doc_id] = scores.get(doc_id, 0) + \
+                    idf * tf * (K1 + 1) / (tf + norm)
+        best = heapq.nsmallest(limit, scores.items(),
+            key=lambda x: (-x[1], x[0]))
+        results = []
+        for doc_id, score in best:
+            path, title, description = self._doc(doc_id)
+            results.append({"path": path, "title": title,
+                "description": description, "score": score})
+        return results
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+from threading import Lock, local
+from time import time
+
+FIELDS = ("filename", "path", "title", "description", "keywords",
+    "timestamp", "date", "image", "thumbnail", "weight")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    dir TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    %s,
+    PRIMARY KEY (dir, kind, position)
+);
+CREATE INDEX IF NOT EXISTS pages_filename ON pages (filename, kind);
+CREATE INDEX IF NOT EXISTS pages_timestamp ON pages (kind, timestamp);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+""" % ",\n    ".join(FIELDS)
+
+_COLUMNS = ", ".join(FIELDS)
+_instances = dict()
+_instances_lock = Lock()
+
+class Entry(object):
+    """A page's metadata in nav data, feeds and the site index. The FIELDS
+    are slots, so a large site's entries take far less memory than dicts.
+    Templates read them as attributes; entry["title"] and
+    entry.get("title") work as they did with dicts."""
+    __slots__ = FIELDS
+    
+    def __init__(self, *values):
+        for f, v in zip(FIELDS, values):
+            setattr(self, f, v)
+    
+    @classmethod
+    def from_dict(cls, data):
+        if data is None:
+            return None
+        return cls(*[data.get(f) for f in FIELDS])
+    
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        if key not in FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __contains__(self, key):
+        return key in FIELDS
+    
+    def __eq__(self, other):
+        return isinstance(other, Entry) and self.values() == other.values()
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __reduce__(self):
+        return Entry, self.values()
+    
+    def __repr__(self):
+        return "Entry(%r)" % self.as_dict()
+    
+    def as_dict(self):
+        return dict(zip(FIELDS, self.values()))
+    
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in FIELDS else default
+    
+    def keys(self):
+        return list(FIELDS)
+    
+    def values(self):
+        return tuple(getattr(self, f) for f in FIELDS)
+
+def nav_from_json(text):
+    """Returns nav data read from a _nav_cache, with Entry objects."""
+    data = json.loads(text)
+    for key in ("folders", "files"):
+        data[key] = [Entry.from_dict(x) for x in data.get(key, [])]
+    for key in ("index", "up"):
+        data[key] = Entry.from_dict(data.get(key))
+    return data
+
+def nav_to_json(data):
+    """Returns nav data in the _nav_cache format."""
+    return json.dumps(data, default=Entry.as_dict)
+
+def markdown_root(path):
+    # Same rule as get_page: everything lives under a "markdown" directory.
+    p = os.path.realpath(path) + "/"
+    i = p.rfind("/markdown/")
+    if i < 0:
+        return None
+    return p[:i + len("/markdown")]
+
+class SiteIndex(object):
+    """Page metadata for a whole site in one SQLite file, _site_index in the
+    markdown directory. Each directory has an "index" row for its own
+    index.md plus "folder" and "file" rows in the same order as its
+    _nav_cache."""
+    
+    def __init__(self, markdowns):
+        self.markdowns = os.path.realpath(markdowns)
+        self.filename = os.path.join(self.markdowns, "_site_index")
+        self._local = local()
+    
+    @classmethod
+    def for_path(cls, path):
+        """Returns the index of the site that path belongs to, or None if
+        the site does not have one."""
+        root = markdown_root(path)
+        if root is None:
+            return None
+        try:
+            ino = os.stat(os.path.join(root, "_site_index")).st_ino
+        except OSError:
+            return None
+        # A rebuilt index is a new file, so it needs new connections.
+        key = (root, os.getpid())
+        with _instances_lock:
+            ino_, instance = _instances.get(key, (None, None))
+            if ino_ != ino:
+                instance = cls(root)
+                _instances[key] = (ino, instance)
+        return instance
+    
+    @property
+    def db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._connect(self.filename)
+            self._local.db = db
+        return db
+    
+    def close(self):
+        """Closes the calling thread's connection to the index."""
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+    
+    def _connect(self, filename):
+        db = sqlite3.connect(filename, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        return db
+    
+    def _insert(self, db, dirname, kind, entries):
+        db.executemany("INSERT INTO pages VALUES (?, ?, ?, %s)" % \
+            ", ".join("?" * len(FIELDS)),
+            [[dirname, kind, i] + [x.get(f) for f in FIELDS] \
+                for i, x in enumerate(entries)])
+    
+    def _rows(self, sql, *args):
+        return [Entry(*row) for row in self.db.execute(sql, args)]
+    
+    def _write_dir(self, db, dirname, index_page, folders, files):
+        db.execute("DELETE FROM pages WHERE dir = ?", (dirname, ))
+        if index_page is not None:
+            self._insert(db, dirname, "index", [index_page])
+        self._insert(db, dirname, "folder", folders)
+        self._insert(db, dirname, "file", files)
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('updated', ?)",
+            (time(), ))
+    
+    def build(self):
+        """Creates the index from scratch out of the _nav_cache files."""
+        from .helpers import atomic_path, get_page
+        with atomic_path(self.filename) as temp:
+            db = self._connect(temp)
+            try:
+                with db:
+                    for dirname, subdirs, files in os.walk(self.markdowns):
+                        if "_nav_cache" not in files:
+                            continue
+                        with open(os.path.join(dirname, "_nav_cache")) as f:
+                            data = nav_from_json(f.read())
+                        self._write_dir(db, os.path.realpath(dirname),
+                            get_page(os.path.join(dirname, "index.md")),
+                            data["folders"], data["files"])
+            finally:
+                db.close()
+        self._local = local()
+    
+    def feed(self, limit):
+        return self._rows("SELECT %s FROM pages WHERE kind = 'file' "
+            "ORDER BY timestamp DESC LIMIT ?" % _COLUMNS, limit)
+    
+    def iter_nav(self, dirname):
+        """Yields (kind, entry) pairs for a directory's index, folders and
+        files, reading rows as they are consumed. Yields nothing if the
+        directory is not in the index."""
+        return self._iter("WHERE dir = ?", os.path.realpath(dirname))
+    
+    def iter_site(self):
+        """Yields (kind, entry) pairs for every directory in the index."""
+        return self._iter("")
+    
+    def _iter(self, where, *args):
+        # Index rows sort first, then folders, then files.
+        cursor = self.db.execute("SELECT kind, %s FROM pages %s ORDER BY "
+            "dir, kind = 'file', kind = 'folder', position" % (_COLUMNS, where),
+            args)
+        for row in cursor:
+            yield row[0], Entry(*row[1:])
+    
+    def load_nav(self, dirname, start=0, stop=None):
+        """Returns the same nav data as helpers.load_nav, or None if the
+        directory is not in the index. Only files[start:stop] are read, and
+        "offset" and "count" tell where they are among all the files."""
+        dirname = os.path.realpath(dirname)
+        index = self.up_level(dirname)
+        if index is None:
+            return None
+        sql = "SELECT %s FROM pages WHERE dir = ? AND kind = ? " \
+            "AND position >= ? AND position < ? ORDER BY position" % _COLUMNS
+        count = self.count(dirname)
+        files = self._rows(sql, dirname, "file", start,
+            count if stop is None else stop)
+        return {
+            "folders": self._rows(sql, dirname, "folder", 0, 2 ** 31),
+            "files": files,
+            "positions": dict((x["filename"], start + i) \
+                for i, x in enumerate(files)),
+            "index": index,
+            "up": self.up_level(os.path.dirname(dirname)),
+            "offset": start,
+            "count": count,
+        }
+    
+    def count(self, dirname):
+        """Returns the number of files in a directory."""
+        row = self.db.execute("SELECT position FROM pages WHERE dir = ? "
+            "AND kind = 'file' ORDER BY position DESC LIMIT 1",
+            (os.path.realpath(dirname), )).fetchone()
+        return row[0] + 1 if row else 0
+    
+    def position(self, dirname, filename):
+        """Returns where a file is among its directory's files."""
+        row = self.db.execute("SELECT position FROM pages WHERE filename = ? "
+            "AND kind = 'file' AND dir = ?",
+            (filename, os.path.realpath(dirname))).fetchone()
+        return row[0] if row else None
+    
+    def update_dir(self, dirname, index_page, folders, files):
+        with self.db as db:
+            self._write_dir(db, os.path.realpath(dirname), index_page,
+                folders, files)
+    
+    def remove_dir(self, dirname):
+        with self.db as db:
+            self._write_dir(db, os.path.realpath(dirname), None, [], [])
+    
+    def updated(self):
+        """Returns when any directory in the index last changed."""
+        row = self.db.execute("SELECT value FROM meta "
+            "WHERE key = 'updated'").fetchone()
+        return row[0] if row else None
+    
+    def up_level(self, dirname):
+        """Returns the metadata of a directory's index.md."""
+        rows = self._rows("SELECT %s FROM pages WHERE dir = ? "
+            "AND kind = 'index'" % _COLUMNS, os.path.realpath(dirname))
+        return rows[0] if rows else None
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+from urllib import quote
+from xml.sax.saxutils import escape
+from .helpers import atomic_file, load_nav, load_nav_slice, \
+    update_nav_cache, write_atomic
+
+# The sitemap protocol allows this many URLs per file.
+SHARD_SIZE = 50000
+
+_URLSET = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+_INDEX = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+
+def _url(base, path, lastmod=None):
+    loc = escape(base + quote((path or u"").encode("utf-8"), safe="/"))
+    if lastmod:
+        return "<url><loc>%s</loc><lastmod>%s</lastmod></url>\n" % \
+            (loc, escape(lastmod))
+    return "<url><loc>%s</loc></url>\n" % loc
+
+def iter_urlset(base, entries, limit=SHARD_SIZE):
+    """Yields a sitemap, line by line, for up to limit (kind, entry) pairs
+    as given by helpers.iter_site. Folders are left out since each one is
+    also its directory's index."""
+    yield _URLSET
+    for kind, entry in entries:
+        if kind == "folder":
+            continue
+        if limit <= 0:
+            break
+        limit -= 1
+        yield _url(base, entry["path"], entry["timestamp"])
+    yield "</urlset>\n"
+
+def _entries(dirname, start, stop):
+    # URL 0 of a directory is its index page, then come its files.
+    nav = load_nav_slice(dirname, max(start - 1, 0), stop - 1)
+    if start == 0 and nav["index"] is not None:
+        yield nav["index"]
+    for x in nav["files"]:
+        yield x
+
+def _dirs(markdowns, previous):
+    # Yields (dir, signature, number of URLs), reading the nav data of
+    # only those directories whose _nav_cache changed.
+    for dirname, subdirs, files in os.walk(markdowns):
+        subdirs.sort()
+        if "index.md" not in files:
+            continue
+        rel = os.path.relpath(dirname, markdowns)
+        if "_nav_cache" not in files:
+            update_nav_cache(dirname)
+        sig = os.path.getmtime(os.path.join(dirname, "_nav_cache"))
+        old_sig, count = previous.get(rel, (None, 0))
+        if old_sig != sig:
+            count = len(load_nav(dirname)["files"]) + 1
+        yield rel, sig, count
+
+def _plan(dirs, boundaries):
+    # Directories are packed in order. A directory that started a shard
+    # last time starts one again, so a change stays within its shard.
+    shards = []
+    current = []
+    size = 0
+    for rel, sig, count in dirs:
+        for start in range(0, count, SHARD_SIZE):
+            n = min(count - start, SHARD_SIZE)
+            if current and (size + n > SHARD_SIZE or \
+                    "%s:%d" % (rel, start) in boundaries):
+                shards.append(current)
+                current = []
+                size = 0
+            current.append([rel, start, start + n, sig])
+            size += n
+    if current:
+        shards.append(current)
+    return shards
+
+def _write_shard(filename, markdowns, base, units):
+    lastmod = None
+    with atomic_file(filename) as f:
+        f.write(_URLSET)
+        for rel, start, stop, sig in units:
+            dirname = os.path.normpath(os.path.join(markdowns, rel))
+            for x in _entries(dirname, start, stop):
+                f.write(_url(base, x["path"], x["timestamp"]))
+                lastmod = max(lastmod, x["timestamp"])
+        f.write("</urlset>\n")
+    return lastmod
+
+def write_sitemap(markdowns, base):
+    """Writes _sitemap.xml, a sitemap index, and the _sitemap-<name>.xml
+    files it lists, each with up to SHARD_SIZE page URLs, to the markdown
+    directory. Shards whose directories' _nav_cache files did not change
+    since the last run, according to _sitemap_manifest, are kept. Returns
+    the number of shards written and the number of shards."""
+    markdowns = os.path.realpath(markdowns)
+    base = base.rstrip("/") + "/"
+    filename = os.path.join(markdowns, "_sitemap_manifest")
+    try:
+        with open(filename) as f:
+            previous = json.loads(f.read())
+    except (IOError, ValueError):
+        previous = dict()
+    if previous.get("url") != base:
+        previous = dict()
+    old_shards = previous.get("shards", dict())
+    dirs = list(_dirs(markdowns, previous.get("dirs", dict())))
+    boundaries = set("%s:%d" % tuple(x["units"][0][:2]) \
+        for x in old_shards.values())
+    shards = dict()
+    order = []
+    written = 0
+    for units in _plan(dirs, boundaries):
+        name = hashlib.sha1(json.dumps(units[0][:2])).hexdigest()[:12]
+        shard = os.path.join(markdowns, "_sitemap-%s.xml" % name)
+        old = old_shards.get(name)
+        if old is not None and old["units"] == units and \
+                os.path.isfile(shard):
+            shards[name] = old
+        else:
+            lastmod = _write_shard(shard, markdowns, base, units)
+            shards[name] = {"units": units, "lastmod": lastmod}
+            written += 1
+        order.append(name)
+    for name in set(old_shards) - set(shards):
+        try:
+            os.remove(os.path.join(markdowns, "_sitemap-%s.xml" % name))
+        except OSError:
+            pass
+    index = [_INDEX]
+    for name in order:
+        loc = escape("%ssitemap-%s.xml" % (base, name))
+        lastmod = shards[name]["lastmod"]
+        if lastmod:
+            index.append("<sitemap><loc>%s</loc><lastmod>%s</lastmod>"
+                "</sitemap>\n" % (loc, escape(lastmod)))
+        else:
+            index.append("<sitemap><loc>%s</loc></sitemap>\n" % loc)
+    index.append("</sitemapindex>\n")
+    write_atomic(os.path.join(markdowns, "_sitemap.xml"), "".join(index))
+    write_atomic(filename, json.dumps({"url": base, "shards": shards,
+        "dirs": dict((rel, [sig, count]) for rel, sig, count in dirs)}))
+    return written, len(order)
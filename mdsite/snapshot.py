@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import cPickle as pickle
+from operator import attrgetter
+from time import time
+from .helpers import atomic_file, get_page, load_nav
+
+EMPTY_NAV = {"folders": [], "files": [], "positions": {}, "index": None,
+    "up": None}
+
+class Snapshot(object):
+    """Every page of a site with its body already rendered, every
+    directory's nav data and the feed entries, held in memory. Load it in
+    the master process before forking so workers share it copy-on-write,
+    and save it to a file so a new release can start without reading the
+    markdown directory."""
+    
+    def __init__(self):
+        self.created = time()
+        self.pages = dict()
+        self.navs = dict()
+        self.feed = []
+    
+    @classmethod
+    def build(cls, markdowns):
+        site = cls()
+        markdowns = os.path.realpath(markdowns)
+        for dirname, subdirs, files in os.walk(markdowns):
+            if "index.md" not in files:
+                continue
+            nav = load_nav(dirname)
+            site.navs[os.path.realpath(dirname)] = nav
+            site.feed += nav["files"]
+            for x in files:
+                if x.startswith("_") or not x.endswith(".md"):
+                    continue
+                filename = os.path.join(dirname, x)
+                page = get_page(filename)
+                if page is None:
+                    continue
+                page["body"]  # Render it now rather than in every worker.
+                page._body = None
+                site.pages[os.path.relpath(filename, markdowns)] = page
+        site.feed.sort(key=attrgetter("timestamp"), reverse=True)
+        return site
+    
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    
+    def get_page(self, requested_path):
+        # Same lookup rules as helpers.get_page, without the file system.
+        rp = requested_path.split("markdown/")
+        if len(rp) < 2:
+            return None
+        rel = rp[-1]
+        if rel.endswith(".md"):
+            candidates = [rel]
+        else:
+            candidates = [os.path.join(rel, "index.md"), "%s.md" % rel]
+        for x in candidates:
+            page = self.pages.get(x)
+            if page is not None:
+                return page.copy()
+        return None
+    
+    def load_nav(self, path):
+        nav = self.navs.get(path)
+        if nav is None:
+            nav = self.navs.get(os.path.realpath(path), EMPTY_NAV)
+        return nav
+    
+    def save(self, filename):
+        with atomic_file(filename, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from threading import Lock, local
+from timeit import default_timer
+
+# Upper bounds of the histogram buckets, in milliseconds.
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+    float("inf"))
+
+class _NoPhase(object):
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+_no_phase = _NoPhase()
+
+class _Phase(object):
+    
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+    
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+    
+    def __exit__(self, *exc):
+        self.timings.record(self.name, default_timer() - self.start)
+        return False
+
+class Timings(object):
+    """Times the phases of requests. Durations are kept per request, to be
+    sent as a Server-Timing header, and added to a latency histogram per
+    phase. Does nothing unless enabled."""
+    
+    def __init__(self):
+        self.enabled = False
+        self.histograms = dict()
+        self._local = local()
+        self._lock = Lock()
+    
+    def phase(self, name):
+        if not self.enabled:
+            return _no_phase
+        return _Phase(self, name)
+    
+    def record(self, name, seconds):
+        ms = seconds * 1000
+        phases = getattr(self._local, "phases", None)
+        if phases is not None:
+            phases.append((name, ms))
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = \
+                    {"count": 0, "total_ms": 0.0, "buckets": [0] * len(BUCKETS)}
+            h["count"] += 1
+            h["total_ms"] += ms
+            h["buckets"][bisect_left(BUCKETS, ms)] += 1
+    
+    def start_request(self):
+        self._local.phases = []
+        self._local.start = default_timer()
+    
+    def finish_request(self):
+        """Records the request's total time and returns all its phases as
+        (name, milliseconds) pairs."""
+        phases = getattr(self._local, "phases", None)
+        if phases is None:
+            return []
+        self.record("total", default_timer() - self._local.start)
+        self._local.phases = None
+        return phases
+    
+    def stats(self):
+        with self._lock:
+            return dict((name, {
+                "count": h["count"],
+                "mean_ms": h["total_ms"] / h["count"],
+                "buckets_ms": [["%g" % b, n] for b, n in \
+                    zip(BUCKETS, h["buckets"]) if n],
+            }) for name, h in self.histograms.items())
+
+timings = Timings()
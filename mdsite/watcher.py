@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+from threading import Thread
+from time import sleep
+from .helpers import find_stale_dirs, read_manifest, update_nav_cache, \
+    write_feed, write_manifest
+
+class Watcher(object):
+    """Polls a markdown directory and, once a burst of edits has settled,
+    rebuilds the _nav_cache files of the directories that changed and the
+    ATOM feed (if a templates directory is given)."""
+    
+    def __init__(self, markdowns, templates=None, interval=2.0, limit=25,
+        log=None):
+        self.markdowns = os.path.realpath(markdowns)
+        self.templates = templates
+        self.interval = interval
+        self.limit = limit
+        self.log = log or (lambda message: None)
+        self.manifest = read_manifest(self.markdowns)
+        self.pending = set()
+    
+    def poll(self):
+        """Scans the tree once. Returns the directories that were updated,
+        which is nothing while files are still changing."""
+        stale, manifest = find_stale_dirs(self.markdowns, self.manifest)
+        settled = manifest == self.manifest
+        self.manifest = manifest
+        self.pending.update(stale)
+        if not self.pending or not settled:
+            return []
+        updated = sorted(self.pending)
+        self.pending = set()
+        for dirname in updated:
+            if update_nav_cache(dirname):
+                self.log("* Updated _nav_cache at %s" % dirname)
+            else:
+                self.log("* Removed %s from the site index" % dirname)
+        write_manifest(self.markdowns, self.manifest)
+        if self.templates:
+            write_feed(self.markdowns, self.templates, self.limit)
+            self.log("* Updated the ATOM feed")
+        return updated
+    
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:  # Keep watching; the next edit may fix it.
+                self.log("! %s" % e)
+            sleep(self.interval)
+    
+    def start(self):
+        t = Thread(target=self.run, name="mdsite-watcher")
+        t.daemon = True
+        t.start()
+        return t
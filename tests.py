@@ -1,20 +1,90 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from mdsite import app, helpers as h
+import zlib
+from argparse import Namespace
+from StringIO import StringIO
+import mdsite
+from mdsite import app, feed_cache, fragment_cache, helpers as h
+from mdsite import siteindex, sitemap
+from mdsite.commands import Commands
+from mdsite.search import SearchIndex, build_index
+from mdsite.snapshot import Snapshot
+from mdsite.timing import timings
+from mdsite.watcher import Watcher
+
+
+def remove_site_files(md):
+    # Connections are closed first so that SQLite's -wal and -shm files go
+    # with the index instead of outliving it.
+    for ino, instance in siteindex._instances.values():
+        instance.close()
+    siteindex._instances.clear()
+    for dirname, subdirs, files in os.walk(md):
+        for x in files:
+            if x.startswith(("_site_index", "_caches_manifest",
+                    "_nav_cache.lock")):
+                os.remove(os.path.join(dirname, x))
 
 
 class MDSiteHelpersTests(unittest.TestCase):
     
+    def tearDown(self):
+        remove_site_files(app.config["MD_FILES"])
+    
     def test_get_page_success(self):
         page = h.get_page(os.path.join(os.getcwd(), "markdown", "index"))
         self.assertTrue(page is not None)
-        self.assertTrue(type(page) is dict)
+        self.assertTrue(isinstance(page, dict))
         self.assertEqual(page["path"], "")
         page = h.get_page(os.path.join(os.getcwd(), "markdown", "page1.md"))
         self.assertEqual(page["path"] , "page1")
     
+    def test_get_page_lazy_body(self):
+        h.page_cache.clear()
+        page = h.get_page(os.path.join(os.getcwd(), "markdown", "index"))
+        self.assertEqual(page["title"], "Here be a MDSite Index")
+        self.assertFalse("body" in page)
+        self.assertIn("<h2>Markdown actually starts here</h2>", page["body"])
+        self.assertIn("<h2>", h.get_page(page["filename"]).get("body"))
+    
+    def test_render_cache(self):
+        directory = tempfile.mkdtemp()
+        h.render_cache.directory = directory
+        try:
+            h.page_cache.clear()
+            path = os.path.join(os.getcwd(), "markdown", "page1.md")
+            body = h.get_page(path)["body"]
+            self.assertEqual(len(os.listdir(directory)), 1)
+            h.page_cache.clear()
+            hits = h.render_cache.hits
+            self.assertEqual(h.get_page(path)["body"], body)
+            self.assertEqual(h.render_cache.hits, hits + 1)
+        finally:
+            h.render_cache.directory = None
+            shutil.rmtree(directory)
+    
+    def test_render_cache_write_failure(self):
+        f, filename = tempfile.mkstemp()
+        os.close(f)
+        # A file where the directory should be makes every write fail.
+        h.render_cache.directory = filename
+        try:
+            h.page_cache.clear()
+            path = os.path.join(os.getcwd(), "markdown", "page1.md")
+            self.assertIn("<h2>", h.get_page(path)["body"])
+        finally:
+            h.render_cache.directory = None
+            os.remove(filename)
+    
     def test_get_page_failure(self):
         # This is simply not a file in MD_FILES.
         page = h.get_page("--not--a-file")
@@ -23,6 +93,19 @@ class MDSiteHelpersTests(unittest.TestCase):
         page = h.get_page("../requirements.txt")
         self.assertTrue(page is None)
     
+    def test_get_page_cache(self):
+        h.page_cache.clear()
+        path = os.path.join(os.getcwd(), "markdown", "page1.md")
+        page = h.get_page(path)
+        page["title"] = u"Changed by the caller"
+        cached = h.get_page(path)
+        self.assertEqual(h.page_cache.hits, 1)
+        self.assertEqual(h.page_cache.misses, 1)
+        self.assertNotEqual(cached["title"], page["title"])
+        h.page_cache.resize(0)
+        self.assertEqual(len(h.page_cache), 0)
+        h.page_cache.resize(256)
+    
     def test_make_context(self):
         # Make sure we're writing a new _nav_cache file.
         nc = os.path.join(app.config["MD_FILES"], "_nav_cache")
@@ -36,6 +119,260 @@ class MDSiteHelpersTests(unittest.TestCase):
         self.assertEqual(context["previous_page"]["path"], "page1")
         self.assertEqual(context["next_page"]["path"], "page3")
         self.assertEqual(context["up_level"]["path"], "")
+        nav = h.load_nav(app.config["MD_FILES"])
+        self.assertEqual(nav["positions"][page["filename"]], 1)
+        self.assertTrue(nav["up"] is None)
+        page = h.get_page(os.path.join(os.getcwd(), "markdown", "subdir"))
+        self.assertEqual(h.make_context(page)["up_level"]["path"], "")
+    
+    def test_load_nav_single_flight(self):
+        md = os.path.join(app.config["MD_FILES"], "subdir")
+        nc = os.path.join(md, "_nav_cache")
+        if os.path.isfile(nc):
+            os.remove(nc)
+        builds = []
+        make_nav_data = h._make_nav_data
+        def counting(path):
+            builds.append(path)
+            return make_nav_data(path)
+        h._make_nav_data = counting
+        try:
+            results = []
+            threads = [threading.Thread(
+                target=lambda: results.append(h.load_nav(md))) \
+                for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            h._make_nav_data = make_nav_data
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(len(results), 8)
+        self.assertEqual(results[0]["index"]["path"], "subdir/")
+    
+    def test_nav_entries(self):
+        md = app.config["MD_FILES"]
+        folders, files = h.make_nav_cache(md)
+        entry = files[0]
+        self.assertEqual(entry["path"], entry.path)
+        self.assertEqual(entry.get("body", "none"), "none")
+        self.assertRaises(KeyError, lambda: entry["body"])
+        self.assertEqual(sorted(dict(entry)), sorted(h.Entry.__slots__))
+        self.assertEqual(pickle.loads(pickle.dumps(entry, 2)), entry)
+        with open(os.path.join(md, "_nav_cache")) as f:
+            text = f.read()
+        self.assertEqual(json.loads(text)["files"][0], entry.as_dict())
+        self.assertEqual(h.nav_from_json(text)["files"], files)
+    
+    def test_write_sitemap(self):
+        md = app.config["MD_FILES"]
+        size = sitemap.SHARD_SIZE
+        sitemap.SHARD_SIZE = 2
+        try:
+            base = "http://www.example.com"
+            self.assertEqual(sitemap.write_sitemap(md, base), (3, 3))
+            self.assertEqual(sitemap.write_sitemap(md, base), (0, 3))
+            h.make_nav_cache(os.path.join(md, "subdir"))
+            self.assertEqual(sitemap.write_sitemap(md, base), (1, 3))
+            with open(os.path.join(md, "_sitemap.xml")) as f:
+                index = f.read()
+            self.assertEqual(index.count("<sitemap>"), 3)
+            self.assertIn("http://www.example.com/sitemap-", index)
+        finally:
+            sitemap.SHARD_SIZE = size
+            for x in os.listdir(md):
+                if x.startswith("_sitemap"):
+                    os.remove(os.path.join(md, x))
+    
+    def test_write_atomic_threads(self):
+        d = tempfile.mkdtemp()
+        filename = os.path.join(d, "target")
+        errors = []
+        def write(n):
+            for i in range(100):
+                try:
+                    h.write_atomic(filename, u"%d" % n * 1000)
+                except Exception as e:
+                    errors.append(e)
+        threads = [threading.Thread(target=write, args=(n, )) \
+            for n in range(4)]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(d), ["target"])
+            with open(filename) as f:
+                self.assertIn(f.read(), ["%d" % n * 1000 for n in range(4)])
+        finally:
+            shutil.rmtree(d)
+    
+    def test_write_sitemap_site_index(self):
+        md = app.config["MD_FILES"]
+        h.make_nav_cache(md)
+        h.make_nav_cache(os.path.join(md, "subdir"))
+        site_index = h.SiteIndex(md)
+        site_index.build()
+        try:
+            os.remove(os.path.join(md, "subdir", "_nav_cache"))
+            self.assertEqual(sitemap.write_sitemap(md, "http://a/"), (1, 1))
+            self.assertTrue(os.path.isfile(
+                os.path.join(md, "subdir", "_nav_cache")))
+        finally:
+            remove_site_files(md)
+            for x in os.listdir(md):
+                if x.startswith("_sitemap"):
+                    os.remove(os.path.join(md, x))
+    
+    def test_atomic_file_failure(self):
+        d = tempfile.mkdtemp()
+        filename = os.path.join(d, "target")
+        h.write_atomic(filename, u"old")
+        def fail():
+            with h.atomic_file(filename, "wb") as f:
+                f.write(b"new")
+                raise ValueError()
+        try:
+            self.assertRaises(ValueError, fail)
+            self.assertEqual(os.listdir(d), ["target"])
+            with open(filename) as f:
+                self.assertEqual(f.read(), "old")
+        finally:
+            shutil.rmtree(d)
+    
+    def test_find_stale_dirs(self):
+        md = app.config["MD_FILES"]
+        h.make_nav_cache(md)
+        h.make_nav_cache(os.path.join(md, "subdir"))
+        stale, manifest = h.find_stale_dirs(md, {})
+        self.assertEqual(stale, [md, os.path.join(md, "subdir")])
+        self.assertEqual(len(manifest), 5)
+        stale, manifest = h.find_stale_dirs(md, manifest)
+        self.assertEqual(stale, [])
+        # A subdirectory's index.md also shows up in its parent's folders.
+        del manifest[os.path.join(md, "subdir", "index.md")]
+        stale, manifest = h.find_stale_dirs(md, manifest)
+        self.assertEqual(stale, [md, os.path.join(md, "subdir")])
+    
+    def test_site_index(self):
+        md = app.config["MD_FILES"]
+        h.make_nav_cache(os.path.join(md, "subdir"))
+        h.make_nav_cache(md)
+        site_index = h.SiteIndex(md)
+        site_index.build()
+        try:
+            self.assertTrue(h.SiteIndex.for_path(md) is not None)
+            folders, files = h.make_nav(md)
+            self.assertEqual([x["path"] for x in files],
+                ["page1", "page2", "page3"])
+            self.assertEqual(folders[0]["path"], "subdir/")
+            info, entries = h.make_feed(md, None, 2)
+            self.assertEqual(len(entries), 2)
+            page = h.get_page(os.path.join(md, "subdir", "index"))
+            self.assertEqual(h.get_up_level(page)["path"], "")
+            self.assertEqual([x[0] for x in h.iter_nav(md)],
+                ["index", "folder", "file", "file", "file"])
+            self.assertEqual(len(list(h.iter_site(md))), 6)
+        finally:
+            remove_site_files(md)
+        self.assertTrue(h.SiteIndex.for_path(md) is None)
+    
+    def test_site_index_removed_dir(self):
+        md = app.config["MD_FILES"]
+        gone = os.path.join(md, "gone")
+        os.mkdir(gone)
+        for x in ("index.md", "p.md"):
+            with open(os.path.join(gone, x), "w") as f:
+                f.write("Title: Gone\nTimestamp: 2099-01-01T00:00:00Z\n"
+                    "Date: Someday\nBody:\nGone.\n")
+        site_index = h.SiteIndex(md)
+        try:
+            stale, manifest = h.find_stale_dirs(md, {})
+            for d in stale:
+                h.update_nav_cache(d)
+            site_index.build()
+            self.assertEqual(h.make_feed(md, None, 1)[1][0]["path"], "gone/p")
+            shutil.rmtree(gone)
+            stale, manifest = h.find_stale_dirs(md, manifest)
+            self.assertEqual(stale, [md, gone])
+            self.assertEqual([h.update_nav_cache(d) for d in stale],
+                [True, False])
+            self.assertNotEqual(h.make_feed(md, None, 1)[1][0]["path"],
+                "gone/p")
+            self.assertFalse([x for k, x in h.iter_site(md) \
+                if x["path"].startswith("gone")])
+        finally:
+            if os.path.isdir(gone):
+                shutil.rmtree(gone)
+            remove_site_files(md)
+    
+    def test_watcher(self):
+        md = app.config["MD_FILES"]
+        w = Watcher(md)
+        w.manifest = dict()
+        # The first scan sees changes, so it waits for them to settle.
+        self.assertEqual(w.poll(), [])
+        self.assertEqual(w.poll(), [os.path.realpath(md),
+            os.path.realpath(os.path.join(md, "subdir"))])
+        self.assertEqual(w.poll(), [])
+        self.assertTrue(os.path.isfile(os.path.join(md, "_caches_manifest")))
+    
+    def test_search_index(self):
+        md = app.config["MD_FILES"]
+        pages, terms = build_index(md)
+        try:
+            self.assertEqual(pages, 5)
+            self.assertTrue(terms > 0)
+            site = SearchIndex.for_path(md)
+            results = site.search("Sub-Directory")
+            self.assertEqual(results[0]["path"], "subdir/")
+            self.assertEqual(len(site.search("page", 2)), 2)
+            self.assertEqual(site.search("nothing-like-this"), [])
+            # A rebuilt index is mapped again and the old mapping closed.
+            build_index(md)
+            self.assertFalse(SearchIndex.for_path(md) is site)
+            self.assertRaises(ValueError, lambda: site.mm[0:1])
+        finally:
+            os.remove(os.path.join(md, "_search_index"))
+    
+    def test_make_context_paged(self):
+        md = app.config["MD_FILES"]
+        index = h.get_page(os.path.join(md, "index"))
+        context = h.make_context(index, 2, 2)
+        self.assertEqual(context["nav_pages"], 2)
+        self.assertEqual([x["path"] for x in context["files"]], ["page3"])
+        context = h.make_context(index, 9, 2)
+        self.assertEqual(context["nav_page"], 2)
+        self.assertEqual([x["path"] for x in context["files"]], ["page3"])
+        page = h.get_page(os.path.join(md, "page3.md"))
+        reads = []
+        read_nav_cache = h._read_nav_cache
+        h._read_nav_cache = lambda path: reads.append(path) or \
+            read_nav_cache(path)
+        try:
+            context = h.make_context(page, window=1)
+        finally:
+            h._read_nav_cache = read_nav_cache
+        self.assertEqual(len(reads), 1)
+        self.assertEqual([x["path"] for x in context["files"]],
+            ["page2", "page3"])
+        self.assertEqual(context["current_index"], 2)
+        self.assertEqual(context["previous_page"]["path"], "page2")
+        self.assertTrue(context["next_page"] is None)
+        h.make_nav_cache(os.path.join(md, "subdir"))
+        site_index = h.SiteIndex(md)
+        site_index.build()
+        try:
+            context = h.make_context(page, window=1)
+            self.assertEqual(context["nav_offset"], 1)
+            self.assertEqual(context["previous_page"]["path"], "page2")
+            context = h.make_context(index, 1, 2)
+            self.assertEqual([x["path"] for x in context["files"]],
+                ["page1", "page2"])
+        finally:
+            remove_site_files(md)
     
     def test_make_feed(self):
         # Make sure we don't have a feed.
@@ -49,6 +386,9 @@ class MDSiteTests(unittest.TestCase):
     def setUp(self):
         self.client = app.test_client()
     
+    def tearDown(self):
+        remove_site_files(app.config["MD_FILES"])
+    
     # ------------- Settings tests.
     def test_settings_tests(self):
         self.assertTrue(os.path.isdir(app.config["MD_FILES"]))
@@ -73,10 +413,268 @@ class MDSiteTests(unittest.TestCase):
         page = self.client.get("/page1")
         self.assertEqual(page.status_code, 200)
     
+    def test_http_conditional_get(self):
+        # The first request may write a _nav_cache, which changes the ETag.
+        self.client.get("/page1")
+        page = self.client.get("/page1")
+        etag = page.headers["ETag"]
+        last_modified = page.headers["Last-Modified"]
+        page = self.client.get("/page1", headers={"If-None-Match": etag})
+        self.assertEqual(page.status_code, 304)
+        self.assertEqual(page.data, "")
+        page = self.client.get("/page1",
+            headers={"If-Modified-Since": last_modified})
+        self.assertEqual(page.status_code, 304)
+        page = self.client.get("/page1", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(page.headers["Content-Encoding"], "gzip")
+        self.assertIn("Here be Page 1", zlib.decompress(page.data, 31))
+        page = self.client.get("/page1",
+            headers={"Accept-Encoding": "gzip;q=0, deflate"})
+        self.assertFalse("Content-Encoding" in page.headers)
+        self.assertIn("Here be Page 1", page.data)
+    
+    def test_http_search(self):
+        md = app.config["MD_FILES"]
+        page = self.client.get("/search?q=page")
+        self.assertEqual(page.status_code, 200)
+        self.assertIn("No pages found.", page.data)
+        build_index(md)
+        try:
+            page = self.client.get("/search?q=Sub-Directory")
+            self.assertNotIn("No pages found.", page.data)
+            first = page.data.split('<a href="')[1].split('"')[0]
+            self.assertEqual(first, "/subdir/")
+            page = self.client.get("/search?q=page")
+            self.assertEqual(page.data.count('<a href="/page'), 3)
+        finally:
+            os.remove(os.path.join(md, "_search_index"))
+    
+    def test_http_snapshot(self):
+        site = Snapshot.build(app.config["MD_FILES"])
+        filename = os.path.join(tempfile.mkdtemp(), "snapshot")
+        site.save(filename)
+        h.use_snapshot(Snapshot.load(filename))
+        try:
+            page = self.client.get("/subdir")
+            self.assertEqual(page.status_code, 200)
+            self.assertIn("Here be Sub-Directory Index", page.data)
+            self.assertEqual(self.client.get("/page2").status_code, 200)
+            self.assertEqual(self.client.get("/page9").status_code, 404)
+            page = self.client.get("/atom")
+            self.assertIn("<id>http://www.example.com/page1</id>", page.data)
+        finally:
+            h.use_snapshot(None)
+            shutil.rmtree(os.path.dirname(filename))
+    
+    def test_http_timing(self):
+        self.assertEqual(self.client.get("/_stats").status_code, 404)
+        timings.enabled = True
+        try:
+            page = self.client.get("/page1")
+            self.assertIn("render;dur=", page.headers["Server-Timing"])
+            self.assertIn("total;dur=", page.headers["Server-Timing"])
+            data = json.loads(self.client.get("/_stats").data)
+            self.assertTrue(data["phases"]["total"]["count"] >= 1)
+            self.assertIn("hits", data["caches"]["page"])
+        finally:
+            timings.enabled = False
+    
+    def test_http_nav_fragment(self):
+        self.client.get("/page1")
+        fragment_cache.clear()
+        page = self.client.get("/page1")
+        self.assertIn('<a href="/subdir/">', page.data)
+        self.client.get("/page2")
+        self.assertEqual((fragment_cache.hits, fragment_cache.misses), (1, 1))
+        nc = os.path.join(app.config["MD_FILES"], "_nav_cache")
+        os.utime(nc, (os.path.getmtime(nc) + 10, ) * 2)
+        page = self.client.get("/page3")
+        self.assertEqual(fragment_cache.misses, 2)
+        self.assertIn('<a href="/page3">', page.data)
+    
+    def test_http_nav_page_past_end(self):
+        app.config["MD_NAV_PAGE_SIZE"] = 2
+        try:
+            page = self.client.get("/?page=9")
+        finally:
+            del app.config["MD_NAV_PAGE_SIZE"]
+        self.assertEqual(page.status_code, 200)
+        self.assertIn("Page 2 of 2", page.data)
+        self.assertIn('<a href="/page3">', page.data)
+    
+    def test_http_nav_template_etag(self):
+        self.client.get("/page1")
+        etag = self.client.get("/page1").headers["ETag"]
+        nav = os.path.join(app.root_path, app.template_folder, "_nav.html")
+        mtime = os.path.getmtime(nav)
+        os.utime(nav, (mtime + 10, ) * 2)
+        try:
+            self.assertNotEqual(self.client.get("/page1").headers["ETag"],
+                etag)
+        finally:
+            os.utime(nav, (mtime, ) * 2)
+    
+    def test_configure_watcher_templates(self):
+        started = []
+        class FakeWatcher(object):
+            def __init__(self, markdowns, templates, *args):
+                started.append(templates)
+            def start(self):
+                pass
+        watcher = mdsite.Watcher
+        templates = app.template_folder
+        mdsite.Watcher = FakeWatcher
+        app.config["MD_WATCH"] = 1
+        app.template_folder = "templates"  # Flask's relative default.
+        try:
+            mdsite.configure()
+        finally:
+            mdsite.Watcher = watcher
+            app.template_folder = templates
+            del app.config["MD_WATCH"]
+        self.assertEqual(started, [os.path.join(app.root_path, "templates")])
+    
+    def test_bytecode_cache(self):
+        directory = os.path.join(tempfile.mkdtemp(), "bytecode")
+        app.config["MD_BYTECODE_CACHE"] = directory
+        makedirs = os.makedirs
+        def racing(path):
+            # Another worker creates the directory first.
+            makedirs(path)
+            raise OSError(17, "File exists")
+        os.makedirs = racing
+        try:
+            mdsite.configure()
+            self.assertTrue(os.path.isdir(directory))
+            self.assertEqual(app.jinja_env.bytecode_cache.directory, directory)
+        finally:
+            os.makedirs = makedirs
+            del app.config["MD_BYTECODE_CACHE"]
+            app.jinja_env.bytecode_cache = None
+            shutil.rmtree(os.path.dirname(directory))
+    
+    def test_http_timing_phases_apart(self):
+        self.client.get("/page2")
+        markdown = h.markdown
+        def slow(*args, **kwargs):
+            time.sleep(0.05)
+            return markdown(*args, **kwargs)
+        h.markdown = slow
+        h.page_cache.clear()
+        timings.enabled = True
+        try:
+            page = self.client.get("/page2")
+        finally:
+            timings.enabled = False
+            h.markdown = markdown
+        phases = dict(x.split(";dur=") \
+            for x in page.headers["Server-Timing"].split(", "))
+        self.assertTrue(float(phases["markdown"]) >= 50)
+        self.assertTrue(float(phases["render"]) < 50)
+    
+    def test_http_api(self):
+        page = self.client.get("/api/page/page1")
+        self.assertEqual(json.loads(page.data)["path"], "page1")
+        self.assertFalse(set(json.loads(page.data)) & \
+            set(["filename", "template"]))
+        page = self.client.get("/api/page/")
+        self.assertIn("<h2>", json.loads(page.data)["body"])
+        self.assertEqual(self.client.get("/api/page/nope").status_code, 404)
+        page = self.client.get("/api/nav/")
+        self.assertEqual(page.mimetype, "application/x-ndjson")
+        lines = [json.loads(x) for x in page.data.splitlines()]
+        self.assertEqual([x["kind"] for x in lines],
+            ["index", "folder", "file", "file", "file"])
+        self.assertEqual(self.client.get("/api/nav/page1").status_code, 404)
+        self.assertFalse([x for x in lines if "filename" in x])
+        page = self.client.get("/api/export")
+        self.assertEqual(len(page.data.splitlines()), 6)
+        self.assertNotIn(app.config["MD_FILES"], page.data)
+    
+    def test_http_sitemap(self):
+        page = self.client.get("/sitemap.xml")
+        self.assertEqual(page.mimetype, "application/xml")
+        self.assertEqual(page.data.count("<url>"), 5)
+        self.assertIn("<loc>http://localhost/page1</loc>", page.data)
+        md = app.config["MD_FILES"]
+        sitemap.write_sitemap(md, "http://www.example.com/")
+        try:
+            page = self.client.get("/sitemap.xml")
+            self.assertIn("<sitemapindex", page.data)
+            shard = page.data.split("http://www.example.com")[1]
+            shard = shard.split("<")[0]
+            page = self.client.get(shard)
+            self.assertEqual(page.data.count("<url>"), 5)
+            page.close()
+            page = self.client.get("/sitemap-nothing.xml")
+            self.assertEqual(page.status_code, 404)
+        finally:
+            for x in os.listdir(md):
+                if x.startswith("_sitemap"):
+                    os.remove(os.path.join(md, x))
+    
     def test_http_atom(self):
         page = self.client.get("/atom")
         self.assertEqual(page.status_code, 200)
         self.assertIn("<id>http://www.example.com/page1</id>", page.data)
+        hits = feed_cache.hits
+        page = self.client.get("/atom")
+        self.assertEqual(feed_cache.hits, hits + 1)
+
+
+
+class MDSiteCommandsTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+    
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.temp)
+    
+    def run_command(self, name, **args):
+        c = Commands()
+        c.args = Namespace(**args)
+        self.assertRaises(SystemExit, getattr(c, name))
+    
+    def test_build(self):
+        md = app.config["MD_FILES"]
+        output = os.path.join(self.temp, "output")
+        args = dict(path=md, directory=app.template_folder, output=output,
+            limit=None, workers=1)
+        try:
+            self.run_command("build", **args)
+            self.assertIn("5 of 5 pages", sys.stdout.getvalue())
+            for x in ("index.html", "page1.html", "subdir/index.html", "atom"):
+                self.assertTrue(os.path.isfile(os.path.join(output, x)))
+            self.assertFalse([x for x in os.listdir(output) \
+                if x.startswith("_")])
+            self.run_command("build", **args)
+            self.assertIn("0 of 5 pages", sys.stdout.getvalue())
+        finally:
+            for x in os.listdir(md):
+                if x.startswith("_build_manifest"):
+                    os.remove(os.path.join(md, x))
+    
+    def test_make_series(self):
+        mds = os.path.join(self.temp, "markdown")
+        images = os.path.join(self.temp, "images")
+        os.mkdir(mds)
+        os.mkdir(images)
+        for batch in (range(3), range(3, 7)):
+            for n in batch:
+                open(os.path.join(images, "%d.png" % n), "w").close()
+            self.run_command("make_series", path=mds, directory=images,
+                title="Series", keywords="series", templates=None,
+                limit=None)
+        stamps = [h.get_page(os.path.join(mds, "%d.md" % n))["timestamp"] \
+            for n in range(7)]
+        self.assertEqual(stamps, sorted(set(stamps)))
+        folders, files = h.make_nav(mds)
+        self.assertEqual([x["path"] for x in files],
+            ["%d" % n for n in range(7)])
 
 
 if __name__ == "__main__":